@@ -0,0 +1,59 @@
+from collections import deque
+
+
+class ChatHistory:
+    """Bounded chat history for the Streamlit session with running totals.
+
+    Only the last `max_entries` exchanges are kept, and each keeps its sources truncated to
+    `source_chars`, so session memory stays flat. Token and cost totals are updated on every
+    add and still count evicted entries, so the metrics never need a scan of the history.
+    """
+
+    def __init__(self, max_entries=50, source_chars=200):
+        self.entries = deque(maxlen=max_entries)
+        self.source_chars = source_chars
+        self.reset_totals()
+
+    def reset_totals(self):
+        self.count = 0
+        self.total_tokens = 0
+        self.total_cost = 0.0
+        self.prompt_tokens_saved = 0
+
+    def truncate(self, source):
+        if len(source) > self.source_chars:
+            return source[: self.source_chars] + "..."
+        return source
+
+    def add(self, question, response):
+        metadata = response["metadata"]
+        self.entries.append({
+            "question": question,
+            "answer": response["answer"],
+            "sources": [self.truncate(source) for source in response["source_documents"]],
+            "metadata": metadata,
+        })
+        self.count += 1
+        self.total_tokens += metadata["total_tokens"]
+        self.total_cost += metadata["total_cost"]
+        self.prompt_tokens_saved += metadata.get("prompt_tokens_saved", 0)
+
+    @property
+    def latest(self):
+        return self.entries[-1] if self.entries else None
+
+    def num_pages(self, page_size):
+        return max(1, -(-len(self.entries) // page_size))
+
+    def page(self, page, page_size):
+        """Entries of one page, newest first; page numbers start at 1."""
+        start = len(self.entries) - (page - 1) * page_size
+        stop = max(start - page_size, 0)
+        return [self.entries[i] for i in range(start - 1, stop - 1, -1)]
+
+    def clear(self):
+        self.entries.clear()
+        self.reset_totals()
+
+    def __len__(self):
+        return len(self.entries)
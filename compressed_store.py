@@ -0,0 +1,251 @@
+import os
+import json
+import logging
+import numpy as np
+
+EMBEDDING_DIM = 1536  # dimension for text-embedding-ada-002
+SCORE_BLOCK_SIZE = 4096  # rows decoded at a time, so a search never expands the whole store
+REPORT_FILE = "memory_recall_report.md"
+
+
+def normalize(vectors):
+    """L2-normalize vectors so that the inner product equals the cosine similarity."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def train_pq(vectors, m=96, n_centroids=256, iterations=15, seed=0):
+    """Train product quantization codebooks of shape (m, n_centroids, dim // m) with k-means."""
+    n, dim = vectors.shape
+    if dim % m:
+        raise ValueError(f"Dimension {dim} is not divisible by m={m}")
+    sub_dim = dim // m
+    n_centroids = min(n_centroids, n)
+    rng = np.random.default_rng(seed)
+    codebooks = np.empty((m, n_centroids, sub_dim), dtype=np.float32)
+
+    for j in range(m):
+        sub = vectors[:, j * sub_dim : (j + 1) * sub_dim]
+        centroids = sub[rng.choice(n, n_centroids, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = _nearest_centroid(sub, centroids)
+            counts = np.bincount(assignments, minlength=n_centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sub)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        codebooks[j] = centroids
+
+    return codebooks
+
+def _nearest_centroid(sub, centroids):
+    distances = (
+        (sub ** 2).sum(axis=1, keepdims=True)
+        - 2 * sub @ centroids.T
+        + (centroids ** 2).sum(axis=1)
+    )
+    return distances.argmin(axis=1)
+
+def encode_pq(vectors, codebooks):
+    """Encode vectors into uint8 PQ codes of shape (n, m)."""
+    m, _, sub_dim = codebooks.shape
+    codes = np.empty((len(vectors), m), dtype=np.uint8)
+    for j in range(m):
+        sub = vectors[:, j * sub_dim : (j + 1) * sub_dim]
+        codes[:, j] = _nearest_centroid(sub, codebooks[j])
+    return codes
+
+
+class CompressedVectorStore:
+    """Local vector cache that searches compressed codes and re-ranks with full-precision vectors.
+
+    Candidate search runs over float16 copies or product-quantized codes held in memory; the
+    top `rerank` candidates are then re-scored with the float32 vectors, which are read from a
+    memory-mapped file so that they stay on disk until needed.
+    """
+
+    def __init__(self, path, mode="float16"):
+        if mode not in ("float16", "pq"):
+            raise ValueError(f"Unknown storage mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.ids = []
+        self.full = None
+        self.codes = None
+        self.codebooks = None
+
+    @property
+    def full_path(self):
+        return f"{self.path}.f32"
+
+    @property
+    def meta_path(self):
+        return f"{self.path}.json"
+
+    @property
+    def codes_path(self):
+        return f"{self.path}.{self.mode}.npz"
+
+    def build(self, ids, vectors, m=96):
+        """Write the full-precision vectors to disk and build the compressed codes."""
+        vectors = normalize(vectors)
+        self.ids = list(ids)
+
+        full = np.memmap(self.full_path, dtype=np.float32, mode="w+", shape=vectors.shape)
+        full[:] = vectors
+        full.flush()
+        del full
+
+        if self.mode == "float16":
+            self.codes = vectors.astype(np.float16)
+            np.savez(self.codes_path, codes=self.codes)
+        else:
+            self.codebooks = train_pq(vectors, m=m)
+            self.codes = encode_pq(vectors, self.codebooks)
+            np.savez(self.codes_path, codes=self.codes, codebooks=self.codebooks)
+
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "dim": int(vectors.shape[1])}, f)
+
+        self._open_full(vectors.shape)
+        logging.info(f"Built {self.mode} store with {len(self.ids)} vectors at {self.path}")
+        return self
+
+    def load(self):
+        """Load the ids and compressed codes, and memory-map the full-precision vectors."""
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.ids = meta["ids"]
+
+        data = np.load(self.codes_path)
+        self.codes = data["codes"]
+        self.codebooks = data["codebooks"] if self.mode == "pq" else None
+
+        self._open_full((len(self.ids), meta["dim"]))
+        return self
+
+    def _open_full(self, shape):
+        self.full = np.memmap(self.full_path, dtype=np.float32, mode="r", shape=shape)
+
+    def candidate_scores(self, query, block_size=SCORE_BLOCK_SIZE):
+        """Approximate cosine scores of the query against every stored vector.
+
+        Codes are decoded block by block, so the extra memory per query is one block of float32
+        values rather than a float32 copy of the whole store.
+        """
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        if self.mode == "float16":
+            for start in range(0, len(self.codes), block_size):
+                block = self.codes[start : start + block_size]
+                scores[start : start + len(block)] = block.astype(np.float32) @ query
+            return scores
+
+        # Asymmetric distance: one lookup table of sub-vector inner products per subspace
+        m, _, sub_dim = self.codebooks.shape
+        table = np.einsum("mcd,md->mc", self.codebooks, query.reshape(m, sub_dim))
+        subspaces = np.arange(m)
+        for start in range(0, len(self.codes), block_size):
+            block = self.codes[start : start + block_size]
+            scores[start : start + len(block)] = table[subspaces, block].sum(axis=1)
+        return scores
+
+    def search(self, query_vector, k=2, rerank=50):
+        """Return the top k (id, score) pairs after re-ranking `rerank` candidates at full precision."""
+        query = normalize(query_vector)
+        scores = self.candidate_scores(query)
+
+        n_candidates = min(max(rerank, k), len(scores))
+        candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        candidates.sort()  # sequential reads from the memory-mapped file
+
+        exact = np.asarray(self.full[candidates]) @ query
+        order = np.argsort(-exact)[:k]
+        return [(self.ids[candidates[i]], float(exact[i])) for i in order]
+
+    def memory_bytes(self):
+        """Bytes held in memory for candidate search (the float32 vectors stay on disk)."""
+        size = self.codes.nbytes
+        if self.codebooks is not None:
+            size += self.codebooks.nbytes
+        return size
+
+
+def fetch_namespace_vectors(index, namespace, batch_size=100):
+    """Fetch every vector id and value stored in a Pinecone namespace."""
+    ids = []
+    vectors = []
+    for id_batch in index.list(namespace=namespace):
+        for i in range(0, len(id_batch), batch_size):
+            response = index.fetch(ids=id_batch[i : i + batch_size], namespace=namespace)
+            for vector_id, vector in response.vectors.items():
+                ids.append(vector_id)
+                vectors.append(vector.values)
+    logging.info(f"Fetched {len(ids)} vectors from namespace '{namespace}'")
+    return ids, np.asarray(vectors, dtype=np.float32)
+
+def recall_at_k(store, exact_vectors, queries, k=10, rerank=50):
+    """Fraction of the exact top-k neighbours that the store returns.
+
+    exact_vectors are the vectors held by the store, in the same order. Queries must not be
+    among them (use held-out vectors or embedded questions), or each query finds itself.
+    """
+    position = {vector_id: i for i, vector_id in enumerate(store.ids)}
+    hits = 0
+    for query in queries:
+        exact = set(np.argsort(-(exact_vectors @ query))[:k])
+        found = {position[i] for i, _ in store.search(query, k=k, rerank=rerank)}
+        hits += len(exact & found)
+    return hits / (k * len(queries))
+
+def memory_recall_report(index_names, folder="vector_cache", n_queries=100, k=10, rerank=50, output_file=REPORT_FILE):
+    """Write memory use and recall@k of the float16 and PQ storage modes for each sphere.
+
+    n_queries vectors of each sphere are held out of the store and used as queries. The
+    markdown table is printed and saved to output_file.
+    """
+    from dotenv import load_dotenv
+    from pinecone import Pinecone
+
+    load_dotenv()
+    pc = Pinecone(api_key=os.getenv("MY_PINECONE_API_KEY"))
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+
+    lines = [
+        f"| sphere | vectors | mode | memory (MB) | vs float32 | recall@{k} |",
+        "|---|---|---|---|---|---|",
+    ]
+    for name, index_name in index_names.items():
+        ids, vectors = fetch_namespace_vectors(pc.Index(index_name), index_name)
+        vectors = normalize(vectors)
+
+        held_out = np.zeros(len(vectors), dtype=bool)
+        held_out[rng.choice(len(vectors), min(n_queries, len(vectors) - k), replace=False)] = True
+        queries = vectors[held_out]
+        stored_ids = [vector_id for vector_id, skip in zip(ids, held_out) if not skip]
+        stored = vectors[~held_out]
+        float32_bytes = stored.nbytes
+
+        for mode in ("float16", "pq"):
+            store = CompressedVectorStore(os.path.join(folder, index_name), mode=mode).build(stored_ids, stored)
+            recall = recall_at_k(store, stored, queries, k=k, rerank=rerank)
+            memory = store.memory_bytes()
+            lines.append(
+                f"| {name} | {len(stored_ids)} | {mode} | {memory / 2**20:.1f} "
+                f"| {memory / float32_bytes:.1%} | {recall:.3f} |"
+            )
+
+    report = "\n".join(lines)
+    print(report)
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(f"{report}\n")
+    logging.info(f"Memory/recall report saved to {output_file}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    memory_recall_report({
+        "Agriculture": "607ff4227b6428eee08802c0",
+        "Education": "607fea9a7b6428eee08802b2",
+    })
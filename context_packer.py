@@ -0,0 +1,110 @@
+import re
+import logging
+import tiktoken
+
+NUMBER_PATTERN = re.compile(r"^-?[\d\s.,]+%?$")
+TERM_PATTERN = re.compile(r"\w{3,}")
+
+
+class ContextPacker:
+    """Builds the "stuff" context from retrieved rows, keeping only relevant fields within a token budget.
+
+    Rows are flattened as "key: value; key: value" (see dedup.row_text). Label fields (text values
+    such as the region or specialty name) are always kept, numeric fields only when their key or
+    value matches the question, falling back to the last `numeric_fallback` of them.
+
+    `prompt_tokens_saved` compares the packed context with what the previous "stuff" chain sent:
+    the whole text of the top `baseline_k` retrieved documents. It is negative when packing more
+    candidates costs more tokens than that.
+    """
+
+    def __init__(self, token_budget=1500, numeric_fallback=3, baseline_k=2, model_name="gpt-3.5-turbo-instruct"):
+        self.token_budget = token_budget
+        self.baseline_k = baseline_k
+        self.numeric_fallback = numeric_fallback
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text))
+
+    @staticmethod
+    def question_terms(question):
+        return {term.casefold() for term in TERM_PATTERN.findall(question)}
+
+    @staticmethod
+    def split_fields(text):
+        fields = []
+        for part in text.split("; "):
+            key, sep, value = part.partition(": ")
+            fields.append((key, value) if sep else ("", part))
+        return fields
+
+    def select_fields(self, fields, terms):
+        """Return the fields of a row worth sending, and how many of them match the question."""
+        labels = []
+        matched = []
+        numeric = []
+
+        for key, value in fields:
+            text = f"{key} {value}".casefold()
+            if any(term in text for term in terms):
+                matched.append((key, value))
+            elif NUMBER_PATTERN.match(value.strip() or "0"):
+                numeric.append((key, value))
+            else:
+                labels.append((key, value))
+
+        if not any(NUMBER_PATTERN.match(value.strip() or "0") for _, value in matched):
+            matched += numeric[-self.numeric_fallback:] if self.numeric_fallback else []
+
+        keep = set(labels + matched)
+        selected = [field for field in fields if field in keep]
+        return selected, len(matched)
+
+    def pack(self, question, documents):
+        """Pack the most relevant fields of the documents into the budget.
+
+        Returns the context string, the documents that made it in, and token statistics.
+        """
+        terms = self.question_terms(question)
+        rows = []
+        for position, doc in enumerate(documents):
+            selected, score = self.select_fields(self.split_fields(doc.page_content), terms)
+            text = "; ".join(f"{k}: {v}" if k else v for k, v in selected)
+            rows.append((-score, position, text, doc))
+
+        raw_tokens = self.count_tokens("\n\n".join(doc.page_content for doc in documents))
+        baseline_tokens = self.count_tokens(
+            "\n\n".join(doc.page_content for doc in documents[: self.baseline_k])
+        )
+
+        parts = []
+        used_docs = []
+        used_tokens = 0
+        for _, _, text, doc in sorted(rows, key=lambda row: row[:2]):
+            tokens = self.count_tokens(text) + 1
+            if used_tokens + tokens > self.token_budget:
+                if parts:
+                    continue
+                # Always send at least the best row, cut to the budget
+                text = self.encoding.decode(self.encoding.encode(text)[: self.token_budget])
+                tokens = self.token_budget
+            parts.append(text)
+            used_docs.append(doc)
+            used_tokens += tokens
+
+        context = "\n\n".join(parts)
+        context_tokens = self.count_tokens(context)
+        stats = {
+            "candidates": len(documents),
+            "packed_rows": len(parts),
+            "raw_context_tokens": raw_tokens,
+            "baseline_context_tokens": baseline_tokens,
+            "context_tokens": context_tokens,
+            "prompt_tokens_saved": baseline_tokens - context_tokens,
+        }
+        logging.getLogger(__name__).info(f"Packed context: {stats}")
+        return context, used_docs, stats
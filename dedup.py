@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import random
+import re
+
+# Keys that are added by our own pipeline and differ between copies of the same row
+IGNORED_KEYS = {"ID", "path_id"}
+
+# Mersenne prime used for the MinHash permutations
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def normalize_text(text):
+    """Lower-case text and collapse whitespace so trivially different copies hash the same."""
+    return re.sub(r"\s+", " ", str(text)).strip().casefold()
+
+def row_text(item):
+    """Flatten a dataset row into the text we embed, leaving out per-file keys like ID and path_id."""
+    return "; ".join(f"{k}: {v}" for k, v in item.items() if k not in IGNORED_KEYS)
+
+def content_hash(text):
+    """Stable hash of the normalized text (unlike the built-in hash(), it is the same across runs)."""
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+def collapse_duplicates(texts, metadata_list):
+    """Collapse identical texts into a single entry whose metadata references every source path_id and filename."""
+    unique_texts = []
+    unique_metadata = []
+    seen = {}
+
+    for text, meta in zip(texts, metadata_list):
+        key = content_hash(text)
+        path_id = meta.get("path_id")
+        filename = meta.get("filename")
+
+        if key not in seen:
+            seen[key] = len(unique_texts)
+            meta = dict(meta)
+            meta["content_hash"] = key
+            meta["path_ids"] = [path_id] if path_id else []
+            meta["filenames"] = [filename] if filename else []
+            unique_texts.append(text)
+            unique_metadata.append(meta)
+            continue
+
+        kept = unique_metadata[seen[key]]
+        if path_id and path_id not in kept["path_ids"]:
+            kept["path_ids"].append(path_id)
+        if filename and filename not in kept["filenames"]:
+            kept["filenames"].append(filename)
+
+    logging.info(f"Exact deduplication kept {len(unique_texts)} of {len(texts)} texts.")
+    return unique_texts, unique_metadata
+
+
+def merge_sources(kept, meta):
+    """Add the path_ids and filenames of meta to the kept row's metadata."""
+    for key in ("path_ids", "filenames"):
+        for value in meta.get(key, []):
+            if value not in kept.setdefault(key, []):
+                kept[key].append(value)
+
+
+class MinHasher:
+    """Computes MinHash signatures of sets of content hashes."""
+
+    def __init__(self, num_perm=128, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.permutations = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)
+        ]
+
+    def signature(self, keys):
+        """Return the MinHash signature of a set of hex content hashes."""
+        values = [int(key[:8], 16) for key in keys]
+        if not values:
+            return [_MAX_HASH] * self.num_perm
+        return [
+            min(((a * v + b) % _PRIME) & _MAX_HASH for v in values)
+            for a, b in self.permutations
+        ]
+
+
+class LSHIndex:
+    """Banded locality-sensitive hashing over MinHash signatures."""
+
+    def __init__(self, num_perm=128, bands=16):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets = [{} for _ in range(bands)]
+
+    def _bucket_keys(self, signature):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield band, tuple(signature[start : start + self.rows])
+
+    def query(self, signature):
+        """Names sharing at least one band with the signature."""
+        candidates = set()
+        for band, bucket_key in self._bucket_keys(signature):
+            candidates.update(self.buckets[band].get(bucket_key, ()))
+        return candidates
+
+    def insert(self, name, signature):
+        for band, bucket_key in self._bucket_keys(signature):
+            self.buckets[band].setdefault(bucket_key, []).append(name)
+
+
+def jaccard(a, b):
+    """Exact Jaccard similarity of two sets."""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class Deduplicator:
+    """Collapses the rows of each new dataset into rows that are already kept (committed).
+
+    Only identical rows (same content hash, which leaves out IGNORED_KEYS) are collapsed: they
+    add their path_ids to the kept row instead of getting a vector. Any other row is embedded,
+    even in a dataset that is a near-duplicate of a kept one (MinHash/LSH over row hashes,
+    verified by exact Jaccard >= threshold), since its differing values must stay searchable.
+    Near-duplicate datasets are reported so yearly or regional copies can be spotted.
+
+    `match` never changes state; `commit` records a dataset once its rows are really kept, so the
+    ingest pipeline only collapses into rows that made it into the index.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, bands=16):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm)
+        self.lsh = LSHIndex(num_perm=num_perm, bands=bands)
+        self.kept = {}          # content_hash -> metadata of the kept row
+        self.dataset_keys = {}  # dataset name -> set of row hashes
+
+    def resolve(self, key):
+        """Kept row hash for a row hash; None if unknown."""
+        return key if key in self.kept else None
+
+    def near_duplicate_of(self, name, keys):
+        """The committed dataset this one is a near-duplicate of, or None."""
+        best, best_score = None, self.threshold
+        for other in self.lsh.query(self.hasher.signature(keys)):
+            if other == name:
+                continue
+            score = jaccard(keys, self.dataset_keys[other])
+            if score >= best_score:
+                best, best_score = other, score
+        return best
+
+    def match(self, name, texts, metadata_list):
+        """Split one dataset's rows into rows to embed and rows collapsing into kept rows.
+
+        Returns (new_texts, new_metadata, merges, keys); merges is a list of
+        (kept content_hash, metadata) and keys is the dataset's set of row hashes.
+        """
+        texts, metadata_list = collapse_duplicates(texts, metadata_list)
+        keys = {meta["content_hash"] for meta in metadata_list}
+        new_texts, new_metadata, merges = self.split(name, keys, texts, metadata_list)
+        return new_texts, new_metadata, merges, keys
+
+    def split(self, name, keys, texts, metadata_list):
+        """Split already collapsed rows of a dataset (with row hashes keys) against the kept rows.
+
+        Returns (new_texts, new_metadata, merges) like `match`.
+        """
+        new_texts, new_metadata, merges = [], [], []
+        for text, meta in zip(texts, metadata_list):
+            target = self.resolve(meta["content_hash"])
+            if target is None:
+                new_texts.append(text)
+                new_metadata.append(meta)
+            else:
+                merges.append((target, meta))
+
+        representative = self.near_duplicate_of(name, keys)
+        if representative is not None:
+            logging.info(
+                f"Dataset {name} is a near-duplicate of {representative}: "
+                f"{len(keys & self.dataset_keys[representative])} rows shared"
+            )
+        logging.info(f"Dataset {name}: {len(new_texts)} new rows, {len(merges)} collapsed into kept rows")
+        return new_texts, new_metadata, merges
+
+    def commit(self, name, keys, new_texts, new_metadata, merges):
+        """Record a dataset whose new rows were kept and whose other rows were merged."""
+        for meta in new_metadata:
+            self.kept[meta["content_hash"]] = meta
+        for target, meta in merges:
+            merge_sources(self.kept[target], meta)
+
+        self.dataset_keys[name] = set(keys)
+        self.lsh.insert(name, self.hasher.signature(keys))
+
+    def discard(self, keys):
+        """Forget kept rows whose vectors were deleted."""
+        for key in keys:
+            self.kept.pop(key, None)
+
+    def restore(self, rows, dataset_keys):
+        """Rebuild the committed state from stored rows and dataset row hashes.
+
+        rows is a list of (content_hash, vector_id, text, path_ids, filenames) of kept rows.
+        """
+        for key, vector_id, text, path_ids, filenames in rows:
+            self.kept[key] = {
+                "id": vector_id,
+                "text": text,
+                "content_hash": key,
+                "path_ids": list(path_ids),
+                "filenames": list(filenames),
+            }
+        for name, keys in dataset_keys.items():
+            self.dataset_keys[name] = set(keys)
+            self.lsh.insert(name, self.hasher.signature(keys))
+
+
+def dataset_name(meta):
+    return meta.get("path_id") or meta.get("filename")
+
+def deduplicate(texts, metadata_list, threshold=0.8):
+    """Collapse identical rows across a whole sphere and report near-duplicate datasets.
+
+    Datasets are processed largest first, so the largest dataset of a near-duplicate group keeps
+    the shared vectors and the others only add their path_ids to them.
+    """
+    datasets = {}
+    for text, meta in zip(texts, metadata_list):
+        rows = datasets.setdefault(dataset_name(meta), ([], []))
+        rows[0].append(text)
+        rows[1].append(meta)
+
+    deduplicator = Deduplicator(threshold=threshold)
+    unique_texts = []
+    for name, (dataset_texts, dataset_metadata) in sorted(
+        datasets.items(), key=lambda item: len(item[1][0]), reverse=True
+    ):
+        new_texts, new_metadata, merges, keys = deduplicator.match(name, dataset_texts, dataset_metadata)
+        deduplicator.commit(name, keys, new_texts, new_metadata, merges)
+        unique_texts.extend(new_texts)
+
+    # Metadata objects of kept rows were updated in place by later merges
+    unique_metadata = [deduplicator.kept[content_hash(text)] for text in unique_texts]
+    logging.info(f"Deduplication kept {len(unique_texts)} of {len(texts)} texts.")
+    return unique_texts, unique_metadata
@@ -1,4 +1,5 @@
 import os
+import re
 import time
 import json
 from urllib.parse import urlparse
@@ -7,6 +8,10 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
+from metadata_index import local_dataset_files
+
+# Dates on the sphere listing, e.g. "12.03.2024"
+DATE_PATTERN = re.compile(r"\b(\d{2})\.(\d{2})\.(\d{4})\b")
 
 def setup_driver(fn):
     chrome_options = webdriver.ChromeOptions()
@@ -46,261 +51,180 @@ def extract_path_id(container):
         print(f"Error extracting path_id: {str(e)}")
         return None
 
-def download_json_files(fn, c):
+def extract_updated(container):
+    """Latest date shown for a dataset on the listing (its last update), as YYYY-MM-DD."""
+    dates = [f"{y}-{m}-{d}" for d, m, y in DATE_PATTERN.findall(container.text)]
+    return max(dates) if dates else None
+
+def iter_listing(driver, fn, c):
+    """Walk the listing pages of a sphere, yielding (container, path_id) for every dataset."""
     BASE_URL = f"https://data.egov.uz/eng/spheres/{fn}"
     PAGE_URL = BASE_URL + "?page={}"
-    
+
+    for page_num in range(1, (c // 10) + 2):
+        print(f"Processing page {page_num}...")
+        driver.get(PAGE_URL.format(page_num))
+        time.sleep(2)  # Added sleep to ensure page loads
+
+        try:
+            WebDriverWait(driver, 20, 1).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, "div.list.d-flex.flex-column"))
+            )
+        except TimeoutException:
+            print(f"Timeout waiting for page {page_num}")
+            continue
+
+        containers = driver.find_elements(By.CSS_SELECTOR, "div.list.d-flex.flex-column")
+        time.sleep(2)  # Added sleep to ensure elements are loaded
+
+        for container in containers:
+            # Extract path_id from the container
+            path_id = extract_path_id(container)
+            if path_id:
+                yield container, path_id
+
+def list_sphere_datasets(fn, c):
+    """Return {path_id: last update date} for every dataset on a sphere's listing, without downloading."""
+    driver = setup_driver(fn)
+    datasets = {}
+    try:
+        for container, path_id in iter_listing(driver, fn, c):
+            datasets[path_id] = extract_updated(container)
+    finally:
+        driver.quit()
+    print(f"Listed {len(datasets)} datasets of sphere {fn}")
+    return datasets
+
+def download_json_files(fn, c, skip_path_ids=None, on_download=None, path_ids=None):
+    """Download the JSON files of a sphere and return the path_ids downloaded.
+
+    With path_ids only those datasets are downloaded (a new copy replaces the local file of an
+    updated dataset) and the listing walk stops once all of them are done. Otherwise every
+    dataset not in skip_path_ids is downloaded.
+    """
+    skip_path_ids = set(skip_path_ids or [])
+    wanted = set(path_ids) if path_ids is not None else None
+    downloaded_path_ids = set()
+
     folder_name = create_download_folder(fn)
+    local_files = local_dataset_files(folder_name) if wanted else {}
     driver = setup_driver(fn)
-    
+
     try:
-        for page_num in range(1, (c // 10) + 2):
-            print(f"Processing page {page_num}...")
-            driver.get(PAGE_URL.format(page_num))
-            time.sleep(2)  # Added sleep to ensure page loads
-            
+        for container, path_id in iter_listing(driver, fn, c):
             try:
+                if wanted is not None and path_id not in wanted:
+                    continue
+                if path_id in skip_path_ids:
+                    print(f"Skipping already downloaded dataset {path_id}")
+                    continue
+
+                # Find JSON download link within the container
+                links_div = container.find_element(By.CLASS_NAME, "links")
+                json_link = links_div.find_element(By.XPATH, ".//a[text()='json']")
+
+                # Initiate download process
+                json_link.click()
+                time.sleep(2)  # Added sleep to ensure the click is registered
+
+                # Handle modal dialog
                 WebDriverWait(driver, 20, 1).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, "div.list.d-flex.flex-column"))
+                    EC.presence_of_element_located((By.ID, "modal"))
                 )
-            except TimeoutException:
-                print(f"Timeout waiting for page {page_num}")
-                continue
-            
-            containers = driver.find_elements(By.CSS_SELECTOR, "div.list.d-flex.flex-column")
-            time.sleep(2)  # Added sleep to ensure elements are loaded
-            
-            for container in containers:
+                time.sleep(3)  # Added sleep to ensure modal is fully loaded
+
+                # Handle checkbox
+                checkbox = driver.find_element(
+                    By.XPATH, 
+                    "//label[.//input[@value='60ae4b8bd47a196d52f26634']]"
+                )
+                checkbox.click()
+                time.sleep(2)  # Added sleep to ensure checkbox click is registered
+
+                # Get existing files before download
+                existing_files = set(os.listdir(folder_name))
+
+                # Click download button
+                download_button = driver.find_element(
+                    By.XPATH, 
+                    "//input[@value='Download dataset']"
+                )
+                download_button.click()
+                time.sleep(2)  # Added sleep to ensure download button click is registered
+
+                # Wait for new file
+                try:
+                    new_filename = wait_for_new_file(folder_name, existing_files)
+                except TimeoutError as e:
+                    print(f"Download failed: {str(e)}")
+                    continue
+
+                # Modify JSON file
+                file_path = os.path.join(folder_name, new_filename)
+                time.sleep(2)  # Added sleep to ensure file is ready to be processed
                 try:
-                    # Extract path_id from the container
-                    path_id = extract_path_id(container)
-                    if not path_id:
-                        continue
-                    
-                    # Find JSON download link within the container
-                    links_div = container.find_element(By.CLASS_NAME, "links")
-                    json_link = links_div.find_element(By.XPATH, ".//a[text()='json']")
-                    
-                    # Initiate download process
-                    json_link.click()
-                    time.sleep(2)  # Added sleep to ensure the click is registered
-                    
-                    # Handle modal dialog
-                    WebDriverWait(driver, 20, 1).until(
-                        EC.presence_of_element_located((By.ID, "modal"))
-                    )
-                    time.sleep(3)  # Added sleep to ensure modal is fully loaded
-                    
-                    # Handle checkbox
-                    checkbox = driver.find_element(
-                        By.XPATH, 
-                        "//label[.//input[@value='60ae4b8bd47a196d52f26634']]"
-                    )
-                    checkbox.click()
-                    time.sleep(2)  # Added sleep to ensure checkbox click is registered
-                    
-                    # Get existing files before download
-                    existing_files = set(os.listdir(folder_name))
-                    
-                    # Click download button
-                    download_button = driver.find_element(
-                        By.XPATH, 
-                        "//input[@value='Download dataset']"
-                    )
-                    download_button.click()
-                    time.sleep(2)  # Added sleep to ensure download button click is registered
-                    
-                    # Wait for new file
-                    try:
-                        new_filename = wait_for_new_file(folder_name, existing_files)
-                    except TimeoutError as e:
-                        print(f"Download failed: {str(e)}")
-                        continue
-                    
-                    # Modify JSON file
-                    file_path = os.path.join(folder_name, new_filename)
-                    time.sleep(2)  # Added sleep to ensure file is ready to be processed
-                    try:
-                        with open(file_path, 'r+', encoding='utf-8') as f:
-                            data = json.load(f)
-                            if isinstance(data, list):
-                                data.insert(0, {"path_id": path_id})
-                                f.seek(0)
-                                json.dump(data, f, ensure_ascii=False, indent=4)
-                                f.truncate()
-                            else:
-                                print(f"Invalid JSON structure in {new_filename}")
-                    except Exception as e:
-                        print(f"Error processing {new_filename}: {str(e)}")
-                    
+                    downloaded = False
+                    with open(file_path, 'r+', encoding='utf-8') as f:
+                        data = json.load(f)
+                        if isinstance(data, list):
+                            data.insert(0, {"path_id": path_id})
+                            f.seek(0)
+                            json.dump(data, f, ensure_ascii=False, indent=4)
+                            f.truncate()
+                            downloaded = True
+                        else:
+                            print(f"Invalid JSON structure in {new_filename}")
                 except Exception as e:
-                    print(f"Error processing container: {str(e)}")
+                    print(f"Error processing {new_filename}: {str(e)}")
                     continue
-            
-            time.sleep(4)  # Added sleep to avoid overwhelming the server
+
+                if not downloaded:
+                    continue
+                downloaded_path_ids.add(path_id)
+
+                # The new copy of an updated dataset replaces the old file
+                old_filename = local_files.get(path_id)
+                if old_filename and old_filename != new_filename:
+                    os.remove(os.path.join(folder_name, old_filename))
+                    print(f"Replaced {old_filename} with {new_filename}")
+
+                # Let the pipeline queue the next stage as soon as the file is on disk
+                if on_download:
+                    on_download(path_id, file_path)
+                if wanted is not None and wanted <= downloaded_path_ids:
+                    break
+
+            except Exception as e:
+                print(f"Error processing container: {str(e)}")
+                continue
     
     finally:
         driver.quit()
-    
+
+    if wanted is not None and wanted - downloaded_path_ids:
+        print(f"Not found or failed: {sorted(wanted - downloaded_path_ids)}")
     print("All files processed successfully!")
+    return downloaded_path_ids
 
 if __name__ == "__main__":
-    sphere_list = [
-		{
-			"guidId": "6076e30d7b6428eee08802aa",
-			"title": {
-				"engText": "Territory"
-			},
-			"structCount": 562,
-            "status": "pending"
-		},
-		{
-			"guidId": "607fe93e7b6428eee08802b0",
-			"title": {
-				"engText": "Economy"
-			},
-            "structCount": 3072,
-			"status": "pending"
-		},
-		{
-			"guidId": "607fea677b6428eee08802b1",
-			"title": {
-				"engText": "Healthcare"
-			},
-			"structCount": 692,
-            "status": "pending"
-		},
-		{
-			"guidId": "607fea9a7b6428eee08802b2",
-			"title": {
-				"engText": "Education"
-			},
-			"structCount": 757,
-            "status": "done"
-		},
-		{
-			"guidId": "607fed667b6428eee08802b3",
-			"title": {
-				"engText": "Culture"
-			},
-			"structCount": 67,
-            "status": "pending"
-		},
-		{
-			"guidId": "607fedbd7b6428eee08802b4",
-			"title": {
-				"engText": "Business"
-			},
-			"structCount": 147,
-            "status": "pending"
-		},
-		{
-			"guidId": "607feecc7b6428eee08802b5",
-			"title": {
-				"engText": "Real estate"
-			},
-			"structCount": 212,
-            "status": "pending"
-		},
-		{
-			"guidId": "607feffa7b6428eee08802b7",
-			"title": {
-				"engText": "SDG"
-			},
-			"structCount": 127,
-            "status": "pending"
-		},
-		{
-			"guidId": "607ff03a7b6428eee08802b8",
-			"title": {
-				"engText": "Tourism and sport"
-			},
-			"structCount": 49,
-            "status": "done"
-		},
-		{
-			"guidId": "607ff0997b6428eee08802b9",
-			"title": {
-				"engText": "Insurance"
-			},
-			"structCount": 4,
-            "status": "done"
-		},
-		{
-			"guidId": "607ff1137b6428eee08802ba",
-			"title": {
-				"engText": "Transportation"
-			},
-			"structCount": 155,
-            "status": "pending"
-		},
-		{
-			"guidId": "607ff2e57b6428eee08802bb",
-			"title": {
-				"engText": "Ecology"
-			},
-			"structCount": 155,
-            "status": "pending"
-		},
-		{
-			"guidId": "607ff3197b6428eee08802bc",
-			"title": {
-				"engText": "Population"
-			},
-			"structCount": 1520,
-            "status": "pending"
-		},
-		{
-			"guidId": "607ff3627b6428eee08802bd",
-			"title": {
-				"engText": "Finance"
-			},
-			"structCount": 1022,
-            "status": "pending"
-		},
-		{
-			"guidId": "607ff39e7b6428eee08802be",
-			"title": {
-				"engText": "Trade"
-			},
-			"structCount": 158,
-            "status": "pending"
-		},
-		{
-			"guidId": "607ff3e67b6428eee08802bf",
-			"title": {
-				"engText": "Offense"
-			},
-			"structCount": 40,
-            "status": "done"
-		},
-		{
-			"guidId": "607ff4227b6428eee08802c0",
-			"title": {
-				"engText": "Agriculture"
-			},
-			"structCount": 1028,
-            "status": "done"
-		},
-		{
-			"guidId": "607ff4557b6428eee08802c1",
-			"title": {
-				"engText": "ICT"
-			},
-			"structCount": 96,
-            "status": "pending"
-		},
-		{
-			"guidId": "607ff4ba7b6428eee08802c2",
-			"title": {
-				"engText": "Justice and judge"
-			},
-			"structCount": 24,
-            "status": "done"
-		}
-	]
-
-    guid_id = "607fea9a7b6428eee08802b2" # Education
-    struct_count=757
-
-    download_json_files(guid_id, struct_count)
\ No newline at end of file
+    # Work list written by egov.sync_sphere_list: only fetch new or updated datasets
+    if os.path.exists("work_list.json"):
+        from egov import group_work_list, record_download
+
+        with open("work_list.json", "r", encoding="utf-8") as f:
+            work_list = json.load(f)
+        for guid_id, sphere in group_work_list(work_list).items():
+            print(f"Syncing {guid_id}: {len(sphere['datasets'])} new or updated datasets")
+            download_json_files(
+                guid_id,
+                sphere["struct_count"],
+                path_ids=sphere["datasets"],
+                on_download=lambda path_id, file_path: record_download(
+                    guid_id, path_id, sphere["datasets"][path_id]
+                ),
+            )
+    else:
+        guid_id = "607fea9a7b6428eee08802b2" # Education
+        struct_count=757
+
+        download_json_files(guid_id, struct_count)
\ No newline at end of file
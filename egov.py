@@ -1,24 +1,165 @@
+import os
+import time
 import requests
 import json
+from metadata_index import local_dataset_files
+from dljsondatawpid import list_sphere_datasets
+
+SPHERE_LIST_FILE = "sphere_list.json"
+SPHERE_LIST_STATE_FILE = "sphere_list_state.json"
+WORK_LIST_FILE = "work_list.json"
+DATASET_STATE_FILE = "dataset_state.json"
+
+def load_json(file_name, default):
+    if not os.path.exists(file_name):
+        return default
+    with open(file_name, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def save_json(file_name, data):
+    with open(file_name, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False)
 
 def get_sphere_list():
+    """Download the sphere catalog, using ETag/If-Modified-Since so an unchanged catalog is not re-downloaded.
+
+    Returns (old_data, new_data); new_data is None when the server reports the catalog unchanged.
+    """
     api_url = "https://data.egov.uz/apiClient/Main/GetSphereList?hasAral=false"
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
     }
 
+    old_data = load_json(SPHERE_LIST_FILE, None)
+    state = load_json(SPHERE_LIST_STATE_FILE, {})
+    if old_data is not None:
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
     response = requests.get(api_url, headers=headers)
 
+    if response.status_code == 304:
+        print("Sphere list not modified since the last sync")
+        return old_data, None
+
     if response.status_code == 200:
         data = response.json()
         # save the data to a file
-        file_name = "sphere_list.json"
-        with open(file_name, "w") as file:
-            json.dump(data, file)
-        print(f"Data saved to {file_name}")
-    else:
-        print("Failed to retrieve data:", response.status_code)
+        save_json(SPHERE_LIST_FILE, data)
+        save_json(SPHERE_LIST_STATE_FILE, {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        })
+        print(f"Data saved to {SPHERE_LIST_FILE}")
+        return old_data, data
+
+    print("Failed to retrieve data:", response.status_code)
+    return old_data, None
+
+def local_path_ids(folder):
+    """Collect the path_ids of the datasets already downloaded into a sphere folder."""
+    return set(local_dataset_files(folder))
+
+def load_dataset_state():
+    """Listing update date of the local copy of every dataset, as {guidId: {path_id: date}}."""
+    return load_json(DATASET_STATE_FILE, {})
+
+def record_download(guid_id, path_id, updated):
+    """Remember the listing update date of a dataset once its new copy is on disk."""
+    state = load_dataset_state()
+    state.setdefault(guid_id, {})[path_id] = updated
+    save_json(DATASET_STATE_FILE, state)
+
+def diff_sphere_datasets(guid_id, listing, known, state):
+    """Compare a sphere's dataset listing with the local datasets and their stored update dates.
+
+    Returns (new, updated, removed) path_ids. Local datasets without a stored date are taken as
+    current, and their listing date is stored in state as the baseline for the next sync.
+    """
+    stored = state.setdefault(guid_id, {})
+    new, updated = [], []
+    for path_id, date in sorted(listing.items()):
+        if path_id not in known:
+            new.append(path_id)
+        elif path_id not in stored:
+            stored[path_id] = date
+        elif date and (not stored[path_id] or date > stored[path_id]):
+            updated.append(path_id)
+    removed = sorted(known - set(listing))
+    return new, updated, removed
+
+def diff_sphere_list(old_data, new_data, list_datasets=list_sphere_datasets):
+    """Diff the dataset listing of every sphere held locally against the local datasets.
+
+    Returns the work list: one entry per new or updated dataset. Each sphere's listing is
+    walked once (page loads only, no downloads) because updates do not change structCount.
+    """
+    old_counts = {
+        sphere["guidId"]: sphere["structCount"]
+        for sphere in (old_data or {}).get("result", [])
+    }
+    state = load_dataset_state()
+    work_list = []
+
+    for sphere in new_data.get("result", []):
+        guid_id = sphere["guidId"]
+        title = sphere["title"].get("engText")
+        known = local_path_ids(guid_id)
+        if not known:
+            # Nothing held locally for this sphere: a full download, not a sync
+            continue
+
+        listing = list_datasets(guid_id, sphere["structCount"])
+        new, updated, removed = diff_sphere_datasets(guid_id, listing, known, state)
+        for change, path_ids in (("new", new), ("updated", updated)):
+            for path_id in path_ids:
+                work_list.append({
+                    "guidId": guid_id,
+                    "title": title,
+                    "struct_count": sphere["structCount"],
+                    "path_id": path_id,
+                    "updated": listing[path_id],
+                    "change": change,
+                })
+        print(
+            f"{title}: {old_counts.get(guid_id, 0)} -> {sphere['structCount']}, {len(known)} held locally, "
+            f"{len(new)} new, {len(updated)} updated, {len(removed)} no longer listed"
+        )
+
+    # Baseline dates of local datasets seen for the first time
+    save_json(DATASET_STATE_FILE, state)
+    return work_list
+
+def group_work_list(work_list):
+    """Group work list entries by sphere: {guidId: {"struct_count", "synced_at", "datasets": {path_id: date}}}."""
+    spheres = {}
+    for dataset in work_list:
+        sphere = spheres.setdefault(dataset["guidId"], {
+            "struct_count": dataset["struct_count"],
+            "synced_at": dataset.get("synced_at", ""),
+            "datasets": {},
+        })
+        sphere["datasets"][dataset["path_id"]] = dataset["updated"]
+    return spheres
+
+def sync_sphere_list():
+    """Refresh the sphere catalog and write the work list of new or updated datasets."""
+    old_data, new_data = get_sphere_list()
+    if new_data is None:
+        # Catalog unchanged (or unavailable): datasets can still have been updated, so the
+        # listings are diffed against the stored catalog
+        new_data = old_data or {"result": []}
 
+    work_list = diff_sphere_list(old_data, new_data)
+    # Download tasks are keyed by sphere and sync run, so every sync gets its own tasks
+    synced_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    for dataset in work_list:
+        dataset["synced_at"] = synced_at
+    save_json(WORK_LIST_FILE, work_list)
+    print(f"{len(work_list)} new or updated datasets saved to {WORK_LIST_FILE}")
+    return work_list
 
 if __name__ == "__main__":
-    get_sphere_list()
\ No newline at end of file
+    sync_sphere_list()
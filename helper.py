@@ -1,27 +1,36 @@
 import os
 import json
 
+def transform_json_file(file_path):
+    """Move the path_id header of a downloaded file onto every row and number the rows.
+
+    Files that were already transformed are left untouched, so this is safe to run again.
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    if not isinstance(data, list) or not data or not isinstance(data[0], dict) or set(data[0]) != {"path_id"}:
+        return False
+
+    # Extract path_id from the first object
+    path_id = data[0].pop("path_id", None)
+
+    # Create a new list where each dict includes the path_id
+    transformed_data = []
+    for index, obj in enumerate(data[1:], start=1):
+        obj["path_id"] = path_id
+        obj["ID"] = str(index)  # Assign sequential ID starting from 1
+        transformed_data.append(obj)
+
+    # Overwrite the original file with the transformed data
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(transformed_data, f, indent=4, ensure_ascii=False)
+    return True
+
 def transform_json_files(folder='607fea9a7b6428eee08802b2'):
     json_files = [f for f in os.listdir(folder) if f.endswith('.json')]
     for json_file in json_files:
-        file_path = os.path.join(folder, json_file)
-
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # Extract path_id from the first object
-        path_id = data[0].pop("path_id", None)
-
-        # Create a new list where each dict includes the path_id
-        transformed_data = []
-        for index, obj in enumerate(data[1:], start=1):
-            obj["path_id"] = path_id
-            obj["ID"] = str(index)  # Assign sequential ID starting from 1
-            transformed_data.append(obj)
-        
-        # Overwrite the original file with the transformed data
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(transformed_data, f, indent=4, ensure_ascii=False)
+        transform_json_file(os.path.join(folder, json_file))
     
     print(f"Transformation complete. Files in the '{folder}' folder have been updated.")
 
@@ -6,6 +6,7 @@ from dotenv import load_dotenv
 from pinecone import Pinecone, ServerlessSpec
 import logging
 import datetime
+from dedup import content_hash, deduplicate, row_text
 
 # Set up logging
 logging.basicConfig(filename=f'process_{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -53,7 +54,22 @@ def chunk_text_by_tokens(text, tokens_per_chunk=500):
     for i in range(0, len(words), tokens_per_chunk):
         yield " ".join(words[i : i + tokens_per_chunk])
 
-def embed_and_upsert(index, texts, metadata_list, batch_size=32):
+def create_embeddings(texts):
+    """Create embeddings for one batch of texts; errors are raised to the caller."""
+    response = openai.Embedding.create(
+        input=texts, 
+        model="text-embedding-ada-002"
+    )
+    return [emb_data["embedding"] for emb_data in response["data"]]
+
+def build_vectors(embeddings, metadata_list):
+    """Pair embeddings with their metadata in the shape Pinecone upserts expect."""
+    return [
+        {"id": meta["id"], "values": embedding, "metadata": meta}
+        for embedding, meta in zip(embeddings, metadata_list)
+    ]
+
+def embed_and_upsert(index, texts, metadata_list, batch_size=32, namespace=None):
     """Takes a list of texts and corresponding metadata, creates embeddings in batches, and upserts to Pinecone."""
     logging.info("Starting embedding and upserting process...")
     for i in range(0, len(texts), batch_size):
@@ -64,42 +80,80 @@ def embed_and_upsert(index, texts, metadata_list, batch_size=32):
         # Create embeddings (batch call)
         try:
             logging.info("Creating embeddings...")
-            response = openai.Embedding.create(
-                input=batch_texts, 
-                model="text-embedding-ada-002"
-            )
+            embeddings = create_embeddings(batch_texts)
             logging.info("Embeddings created successfully.")
         except Exception as e:
             logging.error(f"OpenAI embedding error: {e}")
             continue
         
         # Prepare upsert data for Pinecone
-        vectors = []
-        for j, emb_data in enumerate(response["data"]):
-            embedding = emb_data["embedding"]
-            text = batch_texts[j]
-            meta = batch_metadata[j]
-            vector_id = meta["id"]
-
-            vectors.append({
-                "id": vector_id,
-                "values": embedding,
-                "metadata": meta
-            })
+        vectors = build_vectors(embeddings, batch_metadata)
 
         # Upsert the batch
         try:
             logging.info(f"Upserting {len(vectors)} vectors to Pinecone...")
             index.upsert(
                 vectors=vectors,
-                namespace=global_name
+                namespace=namespace or global_name
             )
             logging.info("Upsert successful.")
         except Exception as e:
             logging.error(f"Pinecone upsert error: {e}")
 
+def extract_texts(filename, data):
+    """Flatten the rows of one JSON file into texts to embed and their metadata."""
+    texts_to_embed = []
+    metadata_list = []
+
+    # Extract text based on the structure of your JSON
+    if isinstance(data, dict):
+        logging.info(f"Extracting data from JSON dictionary...")
+        for k, v in data.items():
+            item_text = f"{k}: {v}"
+            for chunk in chunk_text_by_tokens(item_text):
+                texts_to_embed.append(chunk)
+                text_hash = content_hash(chunk)
+                metadata_list.append({
+                    "id": f"{filename}-{k}-{text_hash}",
+                    "filename": filename,
+                    "key": k,
+                    "value": str(v),
+                    "text": chunk,
+                })
+
+    elif isinstance(data, list):
+        logging.info(f"Extracting data from JSON list...")
+        for idx, item in enumerate(data):
+            if isinstance(item, dict):
+                flat_str = row_text(item)
+                for chunk in chunk_text_by_tokens(flat_str):
+                    texts_to_embed.append(chunk)
+                    text_hash = content_hash(chunk)
+                    metadata_list.append({
+                        "id": f"{filename}-{idx}-{text_hash}",
+                        "filename": filename,
+                        "item_index": idx,
+                        **item,
+                        "text": chunk,
+                    })
+            else:
+                for chunk in chunk_text_by_tokens(str(item)):
+                    texts_to_embed.append(chunk)
+                    text_hash = content_hash(chunk)
+                    metadata_list.append({
+                        "id": f"{filename}-{idx}-{text_hash}",
+                        "filename": filename,
+                        "item_index": idx,
+                        "content": str(item),
+                        "text": chunk,
+                    })
+    else:
+        logging.warning(f"Unexpected JSON structure in file {filename}. Skipping.")
+
+    return texts_to_embed, metadata_list
+
 def process_json_files(global_name, index):
-    """Process JSON files in the specified directory and embed their contents."""
+    """Process JSON files in the specified directory, deduplicate their rows and embed the unique ones."""
     json_directory = global_name
     logging.info(f"Processing JSON files in directory: {json_directory}")
 
@@ -107,6 +161,9 @@ def process_json_files(global_name, index):
         logging.error(f"The directory '{json_directory}' does not exist.")
         raise FileNotFoundError(f"The directory '{json_directory}' does not exist.")
 
+    texts_to_embed = []
+    metadata_list = []
+
     for filename in tqdm.tqdm(os.listdir(json_directory)):
         if not filename.endswith(".json"):
             logging.info(f"Skipping non-JSON file: {filename}")
@@ -124,56 +181,17 @@ def process_json_files(global_name, index):
             logging.error(f"Failed to parse JSON file '{filename}': {e}")
             continue
 
-        texts_to_embed = []
-        metadata_list = []
+        texts, metadata = extract_texts(filename, data)
+        texts_to_embed.extend(texts)
+        metadata_list.extend(metadata)
 
-        # Extract text based on the structure of your JSON
-        if isinstance(data, dict):
-            logging.info(f"Extracting data from JSON dictionary...")
-            for k, v in data.items():
-                item_text = f"{k}: {v}"
-                for chunk in chunk_text_by_tokens(item_text):
-                    texts_to_embed.append(chunk)
-                    text_hash = hash(chunk)
-                    metadata_list.append({
-                        "id": f"{filename}-{k}-{text_hash}",
-                        "filename": filename,
-                        "key": k,
-                        "value": str(v),
-                    })
-
-        elif isinstance(data, list):
-            logging.info(f"Extracting data from JSON list...")
-            for idx, item in enumerate(data):
-                if isinstance(item, dict):
-                    flat_str = "; ".join(f"{k}: {v}" for k, v in item.items())
-                    for chunk in chunk_text_by_tokens(flat_str):
-                        texts_to_embed.append(chunk)
-                        text_hash = hash(chunk)
-                        metadata_list.append({
-                            "id": f"{filename}-{idx}-{text_hash}",
-                            "filename": filename,
-                            "item_index": idx,
-                            **item
-                        })
-                else:
-                    for chunk in chunk_text_by_tokens(str(item)):
-                        texts_to_embed.append(chunk)
-                        text_hash = hash(chunk)
-                        metadata_list.append({
-                            "id": f"{filename}-{idx}-{text_hash}",
-                            "filename": filename,
-                            "item_index": idx,
-                            "content": str(item)
-                        })
-        else:
-            logging.warning(f"Unexpected JSON structure in file {filename}. Skipping.")
-            continue
+    # Collapse identical rows and rows of near-duplicate datasets so each is embedded only once
+    texts_to_embed, metadata_list = deduplicate(texts_to_embed, metadata_list)
 
-        # Embed & upsert
-        if texts_to_embed:
-            logging.info(f"Embedding and upserting {len(texts_to_embed)} texts...")
-            embed_and_upsert(index, texts_to_embed, metadata_list, batch_size=32)
+    # Embed & upsert
+    if texts_to_embed:
+        logging.info(f"Embedding and upserting {len(texts_to_embed)} texts...")
+        embed_and_upsert(index, texts_to_embed, metadata_list, batch_size=32, namespace=global_name)
 
 if __name__ == "__main__":
     global_name = "607fea9a7b6428eee08802b2"
@@ -0,0 +1,352 @@
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Insert a task, or put a finished (done/failed) one back in the queue with a new payload
+_REQUEUE_SQL = """
+    INSERT INTO tasks (dataset, sphere, stage, payload, updated_at) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (dataset, stage) DO UPDATE SET
+        status = 'pending', attempts = 0, error = NULL, lease_until = NULL, lease_token = NULL,
+        sphere = excluded.sphere, payload = excluded.payload, updated_at = excluded.updated_at
+    WHERE tasks.status IN ('done', 'failed')
+"""
+
+
+class JobQueue:
+    """Durable SQLite-backed task queue with one task per (dataset, stage).
+
+    Tasks are claimed with a lease that the worker renews with `heartbeat`; a worker that crashes
+    leaves its task `running` until the lease expires (or `recover()` runs on start-up), after
+    which another worker picks it up, unless the task already used up its attempts: a task that
+    keeps crashing the process is marked failed like one that keeps raising. Only the holder of the current lease can complete or fail
+    a task. `enqueue` ignores tasks that already exist, `requeue` also puts finished tasks back,
+    which is how an updated dataset is re-ingested.
+
+    The same database keeps the large intermediate results (embeddings) in a separate blob table
+    and the rows committed to the index, which drive cross-dataset deduplication.
+    """
+
+    def __init__(self, path="pipeline.db", lease_seconds=600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dataset TEXT NOT NULL,
+                sphere TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                payload TEXT,
+                error TEXT,
+                lease_until REAL,
+                lease_token TEXT,
+                updated_at REAL,
+                UNIQUE (dataset, stage)
+            );
+            CREATE INDEX IF NOT EXISTS tasks_stage_status ON tasks (stage, status);
+            CREATE TABLE IF NOT EXISTS blobs (
+                key TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS rows (
+                sphere TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                vector_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                path_ids TEXT NOT NULL,
+                filenames TEXT NOT NULL,
+                PRIMARY KEY (sphere, content_hash)
+            );
+            CREATE TABLE IF NOT EXISTS dataset_keys (
+                sphere TEXT NOT NULL,
+                dataset TEXT NOT NULL,
+                filename TEXT,
+                keys TEXT NOT NULL,
+                PRIMARY KEY (sphere, dataset)
+            );
+            """
+        )
+
+    def _transaction(self, work):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work()
+                self.conn.execute("COMMIT")
+                return result
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, dataset, sphere, stage, payload=None):
+        """Add a task unless the dataset already has one for this stage. Returns True if added."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO tasks (dataset, sphere, stage, payload, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (dataset, sphere, stage, json.dumps(payload or {}), time.time()),
+            )
+        return cursor.rowcount == 1
+
+    def requeue(self, dataset, sphere, stage, payload=None):
+        """Add a task, or reset a done/failed one to pending with the new payload.
+
+        A task that is pending or running is left alone. Returns True if the task was queued.
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                _REQUEUE_SQL, (dataset, sphere, stage, json.dumps(payload or {}), time.time())
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, stage):
+        """Lease the oldest pending (or lease-expired) task of a stage, or return None."""
+        now = time.time()
+        token = uuid.uuid4().hex
+
+        def work():
+            self.conn.execute(
+                """
+                UPDATE tasks SET status = ?, error = ?, lease_until = NULL, lease_token = NULL, updated_at = ?
+                WHERE stage = ? AND status = ? AND lease_until < ? AND attempts >= ?
+                """,
+                (FAILED, "lease expired on the last attempt", now, stage, RUNNING, now, self.max_attempts),
+            )
+            row = self.conn.execute(
+                """
+                SELECT id, dataset, sphere, stage, attempts, payload FROM tasks
+                WHERE stage = ? AND (status = ? OR (status = ? AND lease_until < ?))
+                ORDER BY id LIMIT 1
+                """,
+                (stage, PENDING, RUNNING, now),
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    """
+                    UPDATE tasks SET status = ?, attempts = attempts + 1, lease_until = ?,
+                        lease_token = ?, updated_at = ? WHERE id = ?
+                    """,
+                    (RUNNING, now + self.lease_seconds, token, now, row[0]),
+                )
+            return row
+
+        row = self._transaction(work)
+        if row is None:
+            return None
+
+        task_id, dataset, sphere, stage, attempts, payload = row
+        return {
+            "id": task_id,
+            "dataset": dataset,
+            "sphere": sphere,
+            "stage": stage,
+            "attempts": attempts + 1,
+            "token": token,
+            "payload": json.loads(payload or "{}"),
+        }
+
+    def heartbeat(self, task):
+        """Extend the lease of a running task. Returns False if the lease was lost to another worker."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE tasks SET lease_until = ? WHERE id = ? AND status = ? AND lease_token = ?",
+                (time.time() + self.lease_seconds, task["id"], RUNNING, task["token"]),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, task, next_stage=None, payload=None):
+        """Mark a task done and, in the same transaction, queue the dataset's next stage.
+
+        The payload of the finished task is cleared. Returns False (and changes nothing) if the
+        worker no longer holds the lease.
+        """
+        now = time.time()
+
+        def work():
+            cursor = self.conn.execute(
+                """
+                UPDATE tasks SET status = ?, payload = NULL, error = NULL, lease_until = NULL,
+                    lease_token = NULL, updated_at = ?
+                WHERE id = ? AND status = ? AND lease_token = ?
+                """,
+                (DONE, now, task["id"], RUNNING, task["token"]),
+            )
+            if cursor.rowcount == 0:
+                return False
+            if next_stage:
+                self.conn.execute(
+                    _REQUEUE_SQL,
+                    (task["dataset"], task["sphere"], next_stage, json.dumps(payload or {}), now),
+                )
+            return True
+
+        completed = self._transaction(work)
+        if not completed:
+            logging.warning(f"{task['stage']} for {task['dataset']} lost its lease, result discarded")
+        return completed
+
+    def fail(self, task, error):
+        """Return a task to the queue, or mark it failed once it used up its attempts."""
+        status = FAILED if task["attempts"] >= self.max_attempts else PENDING
+        with self.lock:
+            self.conn.execute(
+                """
+                UPDATE tasks SET status = ?, error = ?, lease_until = NULL, lease_token = NULL, updated_at = ?
+                WHERE id = ? AND status = ? AND lease_token = ?
+                """,
+                (status, str(error), time.time(), task["id"], RUNNING, task["token"]),
+            )
+        logging.error(f"{task['stage']} failed for {task['dataset']} (attempt {task['attempts']}): {error}")
+
+    def recover(self):
+        """Put tasks left running by a crashed process back in the queue, failing those out of attempts."""
+        def work():
+            failed = self.conn.execute(
+                """
+                UPDATE tasks SET status = ?, error = ?, lease_until = NULL, lease_token = NULL
+                WHERE status = ? AND attempts >= ?
+                """,
+                (FAILED, "interrupted on the last attempt", RUNNING, self.max_attempts),
+            ).rowcount
+            recovered = self.conn.execute(
+                "UPDATE tasks SET status = ?, lease_until = NULL, lease_token = NULL WHERE status = ?",
+                (PENDING, RUNNING),
+            ).rowcount
+            return failed, recovered
+
+        failed, recovered = self._transaction(work)
+        if failed:
+            logging.error(f"{failed} interrupted tasks had no attempts left and were marked failed")
+        if recovered:
+            logging.info(f"Recovered {recovered} interrupted tasks")
+        return recovered
+
+    def retry_failed(self, stage=None):
+        """Give failed tasks (optionally of one stage) a fresh set of attempts."""
+        query = "UPDATE tasks SET status = ?, attempts = 0 WHERE status = ?"
+        params = [PENDING, FAILED]
+        if stage:
+            query += " AND stage = ?"
+            params.append(stage)
+        with self.lock:
+            return self.conn.execute(query, params).rowcount
+
+    def active(self, stages):
+        """Number of pending or running tasks in the given stages."""
+        placeholders = ", ".join("?" for _ in stages)
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT COUNT(*) FROM tasks WHERE stage IN ({placeholders}) AND status IN (?, ?)",
+                (*stages, PENDING, RUNNING),
+            ).fetchone()[0]
+
+    def datasets(self, sphere, stage):
+        """Datasets of a sphere that have a task (in any status) for the stage."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT dataset FROM tasks WHERE sphere = ? AND stage = ?", (sphere, stage)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def counts(self):
+        """Task counts per stage and status, for progress reporting."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT stage, status, COUNT(*) FROM tasks GROUP BY stage, status"
+            ).fetchall()
+        counts = {}
+        for stage, status, count in rows:
+            counts.setdefault(stage, {})[status] = count
+        return counts
+
+    def put_blob(self, key, data):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO blobs (key, data) VALUES (?, ?)", (key, data))
+
+    def get_blob(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM blobs WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def delete_blob(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM blobs WHERE key = ?", (key,))
+
+    def committed_rows(self, sphere):
+        """Rows already in the index for a sphere, as (content_hash, vector_id, text, path_ids, filenames)."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT content_hash, vector_id, text, path_ids, filenames FROM rows WHERE sphere = ?",
+                (sphere,),
+            ).fetchall()
+        return [(h, v, t, json.loads(p), json.loads(f)) for h, v, t, p, f in rows]
+
+    def committed_row(self, sphere, content_hash):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT vector_id, path_ids, filenames FROM rows WHERE sphere = ? AND content_hash = ?",
+                (sphere, content_hash),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), json.loads(row[2])
+
+    def committed_dataset_keys(self, sphere):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT dataset, keys FROM dataset_keys WHERE sphere = ?", (sphere,)
+            ).fetchall()
+        return {dataset: set(json.loads(keys)) for dataset, keys in rows}
+
+    def committed_dataset(self, sphere, dataset):
+        """Row hashes and file name of a dataset's last upsert, or None if it was never upserted."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT keys, filename FROM dataset_keys WHERE sphere = ? AND dataset = ?", (sphere, dataset)
+            ).fetchone()
+        if row is None:
+            return None
+        return set(json.loads(row[0])), row[1]
+
+    def commit_rows(self, sphere, dataset, filename, keys, new_rows, merged_rows, deleted_rows=()):
+        """Record rows once they are in the index.
+
+        new_rows is a list of (content_hash, vector_id, text, path_ids, filenames), merged_rows
+        a list of (content_hash, path_ids, filenames) with the updated sources of kept rows, and
+        deleted_rows the hashes of rows whose vectors were deleted.
+        """
+        def work():
+            self.conn.executemany(
+                "DELETE FROM rows WHERE sphere = ? AND content_hash = ?",
+                [(sphere, h) for h in deleted_rows],
+            )
+            self.conn.executemany(
+                """
+                INSERT OR REPLACE INTO rows (sphere, content_hash, vector_id, text, path_ids, filenames)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                [(sphere, h, v, t, json.dumps(p), json.dumps(f)) for h, v, t, p, f in new_rows],
+            )
+            self.conn.executemany(
+                "UPDATE rows SET path_ids = ?, filenames = ? WHERE sphere = ? AND content_hash = ?",
+                [(json.dumps(p), json.dumps(f), sphere, h) for h, p, f in merged_rows],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dataset_keys (sphere, dataset, filename, keys) VALUES (?, ?, ?, ?)",
+                (sphere, dataset, filename, json.dumps(sorted(keys))),
+            )
+
+        self._transaction(work)
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import logging
+from query_normalizer import normalize_text
+
+METADATA_INDEX_FILE = "metadata_index.json"
+SPHERE_LIST_FILE = "sphere_list.json"
+
+# Column names carry the years of a dataset, e.g. "2020Y", "2019Yil" or "20202021y"
+YEAR_PATTERN = re.compile(r"(?:19|20)\d{2}")
+QUESTION_YEAR_PATTERN = re.compile(r"\b(?:19|20)\d{2}\b")
+PATH_ID_PATTERN = re.compile(r"\b[0-9a-f]{24}\b")
+FILENAME_PATTERN = re.compile(r"\b\d-\d{3}-\d{4}(?:\.json)?\b")
+
+
+def load_sphere_titles(sphere_list_file=SPHERE_LIST_FILE):
+    """Map each sphere guidId to its titles in every language from sphere_list.json."""
+    if not os.path.exists(sphere_list_file):
+        return {}
+    with open(sphere_list_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return {
+        sphere["guidId"]: [title for title in sphere.get("title", {}).values() if title]
+        for sphere in data.get("result", [])
+    }
+
+def dataset_path_id(rows):
+    """Return the path_id of a downloaded dataset, before or after transform_json_files."""
+    return next((row["path_id"] for row in rows if isinstance(row, dict) and row.get("path_id")), None)
+
+def local_dataset_files(folder):
+    """Map the path_id of every dataset downloaded into a sphere folder to its file name."""
+    files = {}
+    if not os.path.isdir(folder):
+        return files
+    for filename in os.listdir(folder):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(folder, filename), "r", encoding="utf-8") as f:
+                rows = json.load(f)
+        except json.JSONDecodeError:
+            continue
+        path_id = dataset_path_id(rows) if isinstance(rows, list) else None
+        if path_id:
+            files[path_id] = filename
+    return files
+
+def dataset_years(rows):
+    """Collect the years mentioned in the column names of a dataset."""
+    years = set()
+    for row in rows:
+        if isinstance(row, dict):
+            for key in row:
+                years.update(YEAR_PATTERN.findall(str(key)))
+    return sorted(years)
+
+def folder_fingerprint(folder):
+    """Number and latest modification time of the JSON files in a sphere folder."""
+    count, latest = 0, 0.0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json"):
+                count += 1
+                latest = max(latest, entry.stat().st_mtime)
+    return [count, latest]
+
+def build_metadata_index(folders, output_file=METADATA_INDEX_FILE, sphere_list_file=SPHERE_LIST_FILE):
+    """Scan downloaded sphere folders and write path_id, filename, sphere and year metadata per dataset."""
+    titles = load_sphere_titles(sphere_list_file)
+    datasets = []
+    fingerprints = {}
+
+    for folder in folders:
+        sphere = os.path.basename(os.path.normpath(folder))
+        fingerprints[sphere] = folder_fingerprint(folder)
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(folder, filename), "r", encoding="utf-8") as f:
+                    rows = json.load(f)
+            except json.JSONDecodeError as e:
+                logging.error(f"Failed to parse JSON file '{filename}': {e}")
+                continue
+            if not isinstance(rows, list):
+                continue
+
+            path_id = dataset_path_id(rows)
+            datasets.append({
+                "path_id": path_id,
+                "filename": filename,
+                "sphere": sphere,
+                "years": dataset_years(rows),
+            })
+
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump({"spheres": titles, "datasets": datasets, "folders": fingerprints}, f, ensure_ascii=False)
+    logging.info(f"Metadata index with {len(datasets)} datasets saved to {output_file}")
+    return MetadataIndex(datasets, titles, fingerprints)
+
+
+class MetadataIndex:
+    """Local index of dataset metadata used to narrow Pinecone queries before vector scoring."""
+
+    def __init__(self, datasets, sphere_titles=None, folders=None):
+        self.datasets = datasets
+        self.sphere_titles = sphere_titles or {}
+        self.folders = folders or {}  # sphere -> folder_fingerprint at build time
+        self.sphere_aliases = self.build_sphere_aliases(self.sphere_titles)
+
+    @staticmethod
+    def build_sphere_aliases(sphere_titles):
+        """Map every title of every sphere (uzbText, uzbKrText, rusText, engText), normalized to Latin, to its guidId."""
+        aliases = {}
+        for guid, titles in sphere_titles.items():
+            for title in titles:
+                alias = normalize_text(title)
+                if alias:
+                    aliases[alias] = guid
+        return aliases
+
+    @classmethod
+    def load(cls, index_file=METADATA_INDEX_FILE):
+        with open(index_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["datasets"], data.get("spheres"), data.get("folders"))
+
+    def covers(self, sphere):
+        """Whether the index was built from the sphere's folder."""
+        return sphere in self.folders
+
+    def is_current(self, folder):
+        """Whether the index covers the sphere folder and no dataset was added, removed or changed since."""
+        sphere = os.path.basename(os.path.normpath(folder))
+        return self.covers(sphere) and self.folders[sphere] == folder_fingerprint(folder)
+
+    def resolve(self, filters, scope=None):
+        """Return the path_ids of datasets matching every filter (path_id, filename, sphere, year).
+
+        Each filter value may be a single value or a list of alternatives. `scope` limits the
+        result to one sphere, e.g. the namespace the retriever is bound to.
+        """
+        def accepted(value):
+            return {str(v) for v in (value if isinstance(value, (list, tuple, set)) else [value])}
+
+        wanted = {key: accepted(value) for key, value in filters.items() if value}
+        path_ids = set()
+
+        for dataset in self.datasets:
+            if scope and dataset["sphere"] != scope:
+                continue
+            if "path_id" in wanted and dataset["path_id"] not in wanted["path_id"]:
+                continue
+            if "filename" in wanted and dataset["filename"] not in {
+                f if f.endswith(".json") else f"{f}.json" for f in wanted["filename"]
+            }:
+                continue
+            if "sphere" in wanted and dataset["sphere"] not in wanted["sphere"]:
+                continue
+            if "year" in wanted and not wanted["year"] & set(dataset["years"]):
+                continue
+            if dataset["path_id"]:
+                path_ids.add(dataset["path_id"])
+
+        return path_ids
+
+    def filter_from_question(self, question):
+        """Derive structured filters from the wording of a question.
+
+        The year filter only matches years found in column names, so callers should treat it as
+        a preference rather than a hard restriction (values may carry the year too).
+        """
+        filters = {}
+        lowered = question.casefold()
+        normalized = normalize_text(question)
+
+        path_ids = PATH_ID_PATTERN.findall(lowered)
+        if path_ids:
+            filters["path_id"] = path_ids
+
+        filenames = FILENAME_PATTERN.findall(question)
+        if filenames:
+            filters["filename"] = filenames
+
+        years = QUESTION_YEAR_PATTERN.findall(question)
+        if years:
+            filters["year"] = years
+
+        spheres = sorted({
+            guid for alias, guid in self.sphere_aliases.items()
+            if re.search(rf"(?<![\w']){re.escape(alias)}(?![\w'])", normalized)
+        })
+        if spheres:
+            filters["sphere"] = spheres
+
+        return filters
+
+    def scope_path_ids(self, scope=None):
+        """All path_ids of a sphere (or of every sphere)."""
+        return {
+            dataset["path_id"] for dataset in self.datasets
+            if dataset["path_id"] and (not scope or dataset["sphere"] == scope)
+        }
+
+    def pinecone_filter(self, path_ids, scope=None):
+        """Pinecone metadata filter restricting a query to the given datasets.
+
+        Returns None when the datasets cover the whole scope, since such a filter excludes nothing.
+        """
+        if set(path_ids) >= self.scope_path_ids(scope):
+            return None
+        path_ids = sorted(path_ids)
+        return {
+            "$or": [
+                {"path_id": {"$in": path_ids}},
+                {"path_ids": {"$in": path_ids}},
+            ]
+        }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    sphere_folders = [d for d in os.listdir(".") if os.path.isdir(d) and PATH_ID_PATTERN.fullmatch(d)]
+    build_metadata_index(sphere_folders)
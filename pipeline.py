@@ -0,0 +1,334 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from array import array
+from jobqueue import JobQueue
+from dedup import Deduplicator, merge_sources
+from egov import group_work_list, load_dataset_state, record_download
+from helper import transform_json_file
+from metadata_index import dataset_path_id
+from dljsondatawpid import download_json_files
+from insert import initialize_pinecone, extract_texts, create_embeddings, build_vectors
+
+# Every dataset moves through these stages as separate tasks. The download task is per sphere and
+# sync run (the scraper walks the sphere listing) and queues one normalize task per downloaded file.
+STAGES = ["download", "normalize", "chunk", "embed", "upsert"]
+NEXT_STAGE = dict(zip(STAGES, STAGES[1:]))
+DEFAULT_WORKERS = {"download": 1, "normalize": 2, "chunk": 2, "embed": 4, "upsert": 2}
+
+EMBED_BATCH_SIZE = 32
+UPSERT_BATCH_SIZE = 100
+
+
+def embeddings_key(task):
+    return f"embeddings/{task['sphere']}/{task['dataset']}"
+
+def drop_source(row, key, value):
+    if value in row[key]:
+        row[key].remove(value)
+
+def source_fields(meta):
+    """The part of a collapsed row's metadata needed to merge it into a kept row."""
+    return {key: meta[key] for key in ("content_hash", "path_ids", "filenames")}
+
+
+class Pipeline:
+    """Runs the scrape -> transform -> ingest stages as overlapping worker pools over a JobQueue.
+
+    Rows are deduplicated with the same Deduplicator as insert.py, one per sphere, restored from
+    the queue database. A row only becomes a kept row once its vector is in the index: chunk
+    matches against kept rows without changing them, and upsert re-checks the rows, writes the
+    index and then records the result. Upserts of a sphere are serialized with an in-process
+    lock, so a sphere must be ingested by a single pipeline process at a time.
+    """
+
+    def __init__(self, queue, workers=None, poll_interval=1.0):
+        self.queue = queue
+        self.workers = workers or DEFAULT_WORKERS
+        self.poll_interval = poll_interval
+        self.indexes = {}
+        self.index_lock = threading.Lock()
+        self.deduplicators = {}
+        self.upsert_locks = {}
+        self.dedup_lock = threading.Lock()
+        self.handlers = {
+            "download": self.download,
+            "normalize": self.normalize,
+            "chunk": self.chunk,
+            "embed": self.embed,
+            "upsert": self.upsert,
+        }
+
+    def get_index(self, sphere):
+        with self.index_lock:
+            if sphere not in self.indexes:
+                self.indexes[sphere] = initialize_pinecone(sphere)
+            return self.indexes[sphere]
+
+    def get_deduplicator(self, sphere):
+        """The sphere's Deduplicator, restored from the rows already in the index. Call with dedup_lock held."""
+        if sphere not in self.deduplicators:
+            deduplicator = Deduplicator()
+            deduplicator.restore(self.queue.committed_rows(sphere), self.queue.committed_dataset_keys(sphere))
+            self.deduplicators[sphere] = deduplicator
+            self.upsert_locks[sphere] = threading.Lock()
+        return self.deduplicators[sphere]
+
+    def download(self, task):
+        payload = task["payload"]
+        sphere = task["sphere"]
+
+        # Datasets fetched by an earlier (failed or interrupted) attempt are not downloaded again
+        downloaded = load_dataset_state().get(sphere, {})
+        wanted = {
+            path_id: updated for path_id, updated in payload["datasets"].items()
+            if path_id not in downloaded or downloaded[path_id] != updated
+        }
+        if not wanted:
+            return None, None
+
+        def on_download(path_id, file_path):
+            record_download(sphere, path_id, wanted[path_id])
+            self.queue.requeue(path_id, sphere, "normalize", {"file_path": file_path})
+
+        download_json_files(sphere, payload["struct_count"], path_ids=wanted, on_download=on_download)
+        # Datasets continue on their own normalize tasks
+        return None, None
+
+    def normalize(self, task):
+        transform_json_file(task["payload"]["file_path"])
+        return "chunk", task["payload"]
+
+    def chunk(self, task):
+        file_path = task["payload"]["file_path"]
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        texts, metadata_list = extract_texts(os.path.basename(file_path), data)
+        with self.dedup_lock:
+            deduplicator = self.get_deduplicator(task["sphere"])
+            new_texts, new_metadata, merges, keys = deduplicator.match(task["dataset"], texts, metadata_list)
+
+        # Rows kept for other datasets only get this dataset's path_id added at upsert time
+        return "embed", {
+            "filename": os.path.basename(file_path),
+            "metadata": new_metadata,
+            "merges": [[target, source_fields(meta)] for target, meta in merges],
+            "keys": sorted(keys),
+        }
+
+    def embed(self, task):
+        payload = task["payload"]
+        texts = [meta["text"] for meta in payload["metadata"]]
+        embeddings = array("f")
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            for embedding in create_embeddings(texts[i : i + EMBED_BATCH_SIZE]):
+                embeddings.extend(embedding)
+
+        # Embeddings are kept out of the task payload and deleted once upserted
+        self.queue.put_blob(embeddings_key(task), embeddings.tobytes())
+        return "upsert", payload
+
+    def load_embeddings(self, task, count):
+        data = self.queue.get_blob(embeddings_key(task))
+        if data is None:
+            raise RuntimeError(f"Embeddings of {task['dataset']} are missing, re-run its embed stage")
+        embeddings = array("f")
+        embeddings.frombytes(data)
+        dimension = len(embeddings) // count
+        return [embeddings[i * dimension : (i + 1) * dimension].tolist() for i in range(count)]
+
+    def upsert(self, task):
+        payload = task["payload"]
+        sphere = task["sphere"]
+        dataset = task["dataset"]
+        keys = set(payload["keys"])
+        metadata_list = payload["metadata"]
+        index = self.get_index(sphere)
+
+        with self.dedup_lock:
+            deduplicator = self.get_deduplicator(sphere)
+            upsert_lock = self.upsert_locks[sphere]
+
+        with upsert_lock:
+            # Rows kept by datasets upserted since the chunk stage are merged instead of upserted
+            with self.dedup_lock:
+                new_texts, new_metadata, late_merges = deduplicator.split(
+                    dataset, keys, [meta["text"] for meta in metadata_list], metadata_list
+                )
+            merges = payload["merges"] + [[target, source_fields(meta)] for target, meta in late_merges]
+
+            if new_metadata:
+                embeddings = dict(zip(
+                    (meta["content_hash"] for meta in metadata_list),
+                    self.load_embeddings(task, len(metadata_list)),
+                ))
+                vectors = build_vectors([embeddings[meta["content_hash"]] for meta in new_metadata], new_metadata)
+                for i in range(0, len(vectors), UPSERT_BATCH_SIZE):
+                    index.upsert(vectors=vectors[i : i + UPSERT_BATCH_SIZE], namespace=sphere)
+
+            # Sources of kept rows are read from the rows table, so concurrent merges are not lost
+            rows = {}
+            previous = self.queue.committed_dataset(sphere, dataset)
+            if previous is not None:
+                # Re-ingested dataset: take it off the rows of its previous version
+                old_keys, old_filename = previous
+                for key in old_keys:
+                    if key in keys and old_filename == payload["filename"]:
+                        continue
+                    row = self.committed(rows, sphere, key)
+                    if key not in keys:
+                        drop_source(row, "path_ids", dataset)
+                        drop_source(row, "filenames", dataset)
+                    drop_source(row, "filenames", old_filename)
+            for target, meta in merges:
+                merge_sources(self.committed(rows, sphere, target), meta)
+
+            # Rows no dataset refers to any more lose their vectors
+            deleted = [key for key, row in rows.items() if not row["path_ids"] and not row["filenames"]]
+            deleted_ids = [rows[key]["id"] for key in deleted]
+            for i in range(0, len(deleted_ids), UPSERT_BATCH_SIZE):
+                index.delete(ids=deleted_ids[i : i + UPSERT_BATCH_SIZE], namespace=sphere)
+            changed = {
+                key: row for key, row in rows.items()
+                if key not in deleted and (row["path_ids"], row["filenames"]) != row["original"]
+            }
+            for row in changed.values():
+                index.update(
+                    id=row["id"],
+                    set_metadata={"path_ids": row["path_ids"], "filenames": row["filenames"]},
+                    namespace=sphere,
+                )
+
+            # Only now that the index has them do the rows count as kept
+            self.queue.commit_rows(
+                sphere,
+                dataset,
+                payload["filename"],
+                keys,
+                [
+                    (meta["content_hash"], meta["id"], text, meta["path_ids"], meta["filenames"])
+                    for text, meta in zip(new_texts, new_metadata)
+                ],
+                [(key, row["path_ids"], row["filenames"]) for key, row in changed.items()],
+                deleted,
+            )
+            with self.dedup_lock:
+                deduplicator.commit(dataset, keys, new_texts, new_metadata, merges)
+                deduplicator.discard(deleted)
+
+        self.queue.delete_blob(embeddings_key(task))
+        logging.info(
+            f"{dataset}: upserted {len(new_metadata)} vectors, updated {len(changed)}, deleted {len(deleted)}"
+        )
+        return None, None
+
+    def committed(self, rows, sphere, key):
+        """Sources of a kept row as stored in the rows table, loaded once per upsert into rows."""
+        if key not in rows:
+            vector_id, path_ids, filenames = self.queue.committed_row(sphere, key)
+            rows[key] = {
+                "id": vector_id,
+                "path_ids": path_ids,
+                "filenames": filenames,
+                "original": (list(path_ids), list(filenames)),
+            }
+        return rows[key]
+
+    def keep_alive(self, task, done):
+        """Renew a task's lease until done is set, so long downloads are not claimed twice."""
+        while not done.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(task):
+                logging.warning(f"{task['stage']} for {task['dataset']} lost its lease")
+                return
+
+    def work(self, stage):
+        """Worker loop: process tasks of one stage until it and every upstream stage are drained."""
+        upstream = STAGES[: STAGES.index(stage) + 1]
+        while True:
+            task = self.queue.claim(stage)
+            if task is None:
+                if not self.queue.active(upstream):
+                    return
+                time.sleep(self.poll_interval)
+                continue
+
+            done = threading.Event()
+            heartbeat = threading.Thread(target=self.keep_alive, args=(task, done), daemon=True)
+            heartbeat.start()
+            try:
+                next_stage, payload = self.handlers[stage](task)
+                self.queue.complete(task, next_stage, payload)
+            except Exception as e:
+                self.queue.fail(task, e)
+            finally:
+                done.set()
+                heartbeat.join()
+
+    def run(self):
+        """Resume interrupted tasks and run every stage's worker pool until the queue is drained."""
+        self.queue.recover()
+        threads = [
+            threading.Thread(target=self.work, args=(stage,), name=f"{stage}-{n}", daemon=True)
+            for stage, count in self.workers.items()
+            for n in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logging.info(f"Pipeline finished: {self.queue.counts()}")
+
+
+def seed_downloads(queue, work_list):
+    """Queue one download task per sphere for the new or updated datasets of a work list.
+
+    The work list is written by egov.sync_sphere_list. Tasks are keyed by sphere and sync run, so
+    a new work list is never dropped as a duplicate.
+    """
+    for guid_id, sphere in group_work_list(work_list).items():
+        queue.enqueue(f"{guid_id}@{sphere['synced_at']}", guid_id, "download", {
+            "struct_count": sphere["struct_count"],
+            "datasets": sphere["datasets"],
+        })
+
+def requeue_file(queue, file_path, sphere=None):
+    """Queue a downloaded dataset for normalize again, e.g. after it was updated. Returns the dataset key."""
+    sphere = sphere or os.path.basename(os.path.dirname(os.path.abspath(file_path)))
+    with open(file_path, "r", encoding="utf-8") as f:
+        rows = json.load(f)
+    dataset = (dataset_path_id(rows) if isinstance(rows, list) else None) or os.path.basename(file_path)
+    queue.requeue(dataset, sphere, "normalize", {"file_path": file_path})
+    return dataset
+
+def seed_local(queue, folder):
+    """Queue normalize tasks for the datasets already downloaded into a sphere folder."""
+    sphere = os.path.basename(os.path.normpath(folder))
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith(".json"):
+            continue
+        file_path = os.path.join(folder, filename)
+        with open(file_path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+        dataset = dataset_path_id(rows) if isinstance(rows, list) else None
+        queue.enqueue(dataset or filename, sphere, "normalize", {"file_path": file_path})
+
+
+if __name__ == "__main__":
+    queue = JobQueue("pipeline.db")
+
+    if len(sys.argv) > 2 and sys.argv[1] == "requeue":
+        # python pipeline.py requeue <sphere>/<file>.json ... re-ingests updated datasets
+        for file_path in sys.argv[2:]:
+            print(f"Requeued {requeue_file(queue, file_path)}")
+    elif os.path.exists("work_list.json"):
+        with open("work_list.json", "r", encoding="utf-8") as f:
+            seed_downloads(queue, json.load(f))
+    else:
+        seed_local(queue, "607fea9a7b6428eee08802b2")  # Education
+
+    Pipeline(queue).run()
+    print(json.dumps(queue.counts(), indent=4))
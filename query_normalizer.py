@@ -0,0 +1,158 @@
+import re
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+# Uzbek Cyrillic -> Latin (2023 alphabet). Russian-only letters map to their usual Latin spelling.
+CYRILLIC_TO_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "ғ": "g'", "д": "d", "е": "e", "ё": "yo",
+    "ж": "j", "з": "z", "и": "i", "й": "y", "к": "k", "қ": "q", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ў": "o'",
+    "ф": "f", "х": "x", "ҳ": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "'",
+    "ы": "i", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+VOWELS = set("аеёиоуўэюяыaeiou")
+
+# All the characters used for the Uzbek o'/g' apostrophe in the wild
+APOSTROPHES = re.compile(r"[ʻʼ’‘`´ʹ]")
+CYRILLIC = re.compile(r"[а-яёўқғҳ]", re.IGNORECASE)
+UZBEK_LATIN_MARKERS = re.compile(
+    r"\b\w*(?:o'|g')\w*\b|\w'(?!(?:s|t|d|m|ll|re|ve)\b)\w|\b\w+(?:lari|larni|larning|dagi)\b"
+    r"|\b(?:va|uchun|qancha|necha|nechta|soni|qaysi|yil|yili|viloyat|viloyati)\b",
+    re.IGNORECASE,
+)
+# Russian questions as they come out of cyrillic_to_latin, so they are still recognized once normalized
+RUSSIAN_LATIN_MARKERS = re.compile(
+    r"\b(?:v|po|na|skolko|kakoy|kakaya|kakiye|gde|godu|god|goda|oblasti|rayone|shkol)\b", re.IGNORECASE
+)
+
+
+def normalize_apostrophes(text):
+    return APOSTROPHES.sub("'", text)
+
+def cyrillic_to_latin(text):
+    """Transliterate Uzbek (or Russian) Cyrillic text to Uzbek Latin."""
+    result = []
+    previous = ""
+    for char in text:
+        lower = char.lower()
+        if lower not in CYRILLIC_TO_LATIN:
+            result.append(char)
+            previous = lower
+            continue
+        latin = CYRILLIC_TO_LATIN[lower]
+        # "е" is written "ye" at the start of a word and after a vowel
+        if lower == "е" and (not previous.isalpha() or previous in VOWELS):
+            latin = "ye"
+        if char.isupper() and latin:
+            latin = latin[0].upper() + latin[1:]
+        result.append(latin)
+        previous = lower
+    return "".join(result)
+
+def normalize_text(text):
+    """Canonical form used for matching and cache keys: Latin script, one apostrophe, casefolded."""
+    text = normalize_apostrophes(text)
+    if CYRILLIC.search(text):
+        text = cyrillic_to_latin(text)
+    text = re.sub(r"[^\w'\s-]", " ", text.casefold())
+    return re.sub(r"\s+", " ", text).strip()
+
+def looks_english(text):
+    """Cheap check used to skip translation: ASCII only and no Uzbek or transliterated Russian markers.
+
+    Meant for normalize_text output, so every script variant of a question gets the same answer.
+    """
+    return (
+        text.isascii()
+        and not CYRILLIC.search(text)
+        and not UZBEK_LATIN_MARKERS.search(text)
+        and not RUSSIAN_LATIN_MARKERS.search(text)
+    )
+
+
+class LRUCache:
+    """Small in-memory least-recently-used cache."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+class TranslationCache:
+    """Persistent SQLite cache of query translations keyed by the normalized query."""
+
+    def __init__(self, path="query_cache.db"):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations (query TEXT PRIMARY KEY, translation TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, query):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT translation FROM translations WHERE query = ?", (query,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, query, translation):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO translations (query, translation) VALUES (?, ?)",
+                (query, translation),
+            )
+            self.conn.commit()
+
+
+class QueryNormalizer:
+    """Turns Uzbek (Latin or Cyrillic), Russian or English questions into one canonical search text.
+
+    `translate` is any callable that returns the English translation of a text; its results are
+    cached by normalized query so that variants of the same question (other script, other
+    apostrophe, other casing) reuse a single translation, embedding and retrieval result.
+    """
+
+    def __init__(self, translate=None, cache=None):
+        self.translate = translate
+        self.cache = cache
+
+    def search_text(self, question):
+        normalized = normalize_text(question)
+        # Decided on the normalized form, so Latin and Cyrillic variants are treated alike
+        if self.translate is None or looks_english(normalized):
+            return normalized
+
+        translation = self.cache.get(normalized) if self.cache else None
+        if translation is None:
+            try:
+                translation = normalize_text(self.translate(question))
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Translation failed, using the original query: {e}")
+                return normalized
+            if self.cache:
+                self.cache.put(normalized, translation)
+
+        # Keep the Latin original too: column names and many values are Uzbek
+        return translation if translation == normalized else f"{translation} ({normalized})"
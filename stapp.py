@@ -1,7 +1,9 @@
 import streamlit as st
 import os
+import json
+import time
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 from dotenv import load_dotenv
 import openai
@@ -9,10 +11,15 @@ from pinecone import Pinecone
 from langchain.vectorstores import Pinecone as PineconeVectorStore
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.prompts import PromptTemplate
+from langchain.schema import Document
 from langchain.llms import OpenAI
-from langchain.chains import RetrievalQA
+from langchain.chains import LLMChain
 from langchain.callbacks import get_openai_callback
 from tenacity import retry, stop_after_attempt, wait_exponential
+from chat_history import ChatHistory
+from context_packer import ContextPacker
+from metadata_index import METADATA_INDEX_FILE, PATH_ID_PATTERN, MetadataIndex, build_metadata_index
+from query_normalizer import LRUCache, QueryNormalizer, TranslationCache
 
 # Configure logging
 logging.basicConfig(
@@ -22,6 +29,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+HISTORY_PAGE_SIZE = 5
+# Seconds between checks of the sphere folder for datasets ingested since the metadata index was built
+METADATA_CHECK_INTERVAL = 60
+# retrieval_filters result for explicit filters that match no dataset
+NO_MATCH = {}
+
 
 class RAGApplication:
     def __init__(self):
@@ -29,6 +42,7 @@ class RAGApplication:
         try:
             self.load_environment()
             self.initialize_clients()
+            self.load_metadata_index()
             self.setup_prompts()
             self.setup_pipeline()
         except Exception as e:
@@ -56,11 +70,15 @@ class RAGApplication:
             self.pc = Pinecone(api_key=self.pinecone_api_key)
 
             self.embeddings = OpenAIEmbeddings(openai_api_key=self.openai_api_key)
-            self.index = self.pc.Index(self.index_name)
+            self.vector_stores = {}
+            self.vector_store = self.get_vector_store(self.index_name)
 
-            self.vector_store = PineconeVectorStore(
-                index=self.index, embedding=self.embeddings, text_key="text"
-            )
+            # Every ingested sphere has its own index, named (and namespaced) by its guidId
+            try:
+                self.sphere_indexes = set(self.pc.list_indexes().names())
+            except Exception as e:
+                logger.warning(f"Could not list Pinecone indexes, questions will not be routed: {str(e)}")
+                self.sphere_indexes = {self.index_name}
 
             logger.info("Successfully initialized all clients and connections")
 
@@ -68,6 +86,111 @@ class RAGApplication:
             logger.error(f"Error initializing clients: {str(e)}")
             raise
 
+    def get_vector_store(self, sphere: str) -> PineconeVectorStore:
+        """Vector store over the index and namespace of a sphere."""
+        if sphere not in self.vector_stores:
+            self.vector_stores[sphere] = PineconeVectorStore(
+                index=self.pc.Index(sphere),
+                embedding=self.embeddings,
+                text_key="text",
+                namespace=sphere,
+            )
+        return self.vector_stores[sphere]
+
+    def load_metadata_index(self):
+        """Load the local dataset metadata index, rebuilding it when a sphere folder changed.
+
+        The index covers every downloaded sphere folder. It is rebuilt when a folder was added or
+        when datasets were added to or updated in one (e.g. by pipeline.py) since it was built.
+        """
+        self.metadata_checked_at = time.time()
+        try:
+            index = MetadataIndex.load() if os.path.exists(METADATA_INDEX_FILE) else None
+            folders = sorted(
+                name for name in os.listdir(".") if os.path.isdir(name) and PATH_ID_PATTERN.fullmatch(name)
+            )
+
+            if folders and (
+                index is None
+                or set(index.folders) != set(folders)
+                or not all(index.is_current(folder) for folder in folders)
+            ):
+                index = build_metadata_index(folders)
+
+            if index is None:
+                logger.warning("No metadata index available, retrieval will not be filtered or routed")
+            elif not index.covers(self.index_name):
+                logger.warning(f"Metadata index does not cover {self.index_name}, its datasets cannot be filtered")
+            self.metadata_index = index
+
+        except Exception as e:
+            logger.error(f"Error loading metadata index: {str(e)}")
+            self.metadata_index = None
+
+    def refresh_metadata_index(self):
+        """Pick up datasets ingested while the app runs, checking the folder at most once per interval."""
+        if time.time() - self.metadata_checked_at >= METADATA_CHECK_INTERVAL:
+            self.load_metadata_index()
+
+    def route(self, question: str, filters: Optional[Dict[str, Any]] = None) -> str:
+        """Pick the sphere whose index and namespace are searched.
+
+        A single sphere named in the explicit filters, or by any of its titles (Uzbek Latin or
+        Cyrillic, Russian, English) in the question, is searched when it has an index; otherwise
+        the default sphere is.
+        """
+        if self.metadata_index is None:
+            return self.index_name
+        if filters is not None:
+            spheres = filters.get("sphere")
+        else:
+            spheres = self.metadata_index.filter_from_question(question).get("sphere")
+        spheres = [spheres] if isinstance(spheres, str) else list(spheres or [])
+        if len(spheres) == 1 and spheres[0] in self.sphere_indexes:
+            return spheres[0]
+        return self.index_name
+
+    def retrieval_filters(
+        self, question: str, filters: Optional[Dict[str, Any]] = None, scope: Optional[str] = None
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Build Pinecone filters from explicit filters or from filters derived from the question.
+
+        Returns (hard_filter, preferred_filter) for the sphere `scope` (the default sphere if not
+        given). Explicit filters are always hard, and when they match no dataset hard_filter is
+        NO_MATCH, so nothing is retrieved. Of the derived ones, the sphere is handled by `route`
+        and the year is only preferred: it matches column names, so datasets that keep the year
+        in their values must still be reachable.
+        """
+        scope = scope or self.index_name
+        if self.metadata_index is None:
+            return None, None
+
+        if filters is not None:
+            path_ids = self.metadata_index.resolve(filters, scope=scope)
+            if not path_ids:
+                return NO_MATCH, None
+            return self.metadata_index.pinecone_filter(path_ids, scope), None
+
+        derived = self.metadata_index.filter_from_question(question)
+        hard = {key: value for key, value in derived.items() if key not in ("year", "sphere")}
+
+        hard_filter = None
+        hard_path_ids = self.metadata_index.resolve(hard, scope=scope)
+        # A guess from the wording should never hide the whole namespace
+        if hard and hard_path_ids:
+            hard_filter = self.metadata_index.pinecone_filter(hard_path_ids, scope)
+        else:
+            hard = {}
+            hard_path_ids = self.metadata_index.scope_path_ids(scope)
+
+        preferred_filter = None
+        if "year" in derived:
+            path_ids = self.metadata_index.resolve(dict(hard, year=derived["year"]), scope=scope)
+            if path_ids and path_ids != hard_path_ids:
+                preferred_filter = self.metadata_index.pinecone_filter(path_ids, scope)
+
+        return hard_filter, preferred_filter
+
     def setup_prompts(self):
         """Configure the prompt templates."""
         self.default_prompt = PromptTemplate(
@@ -95,13 +218,22 @@ Answer:
                 api_key=self.openai_api_key, temperature=0.7, max_tokens=500
             )
 
-            self.qa_chain = RetrievalQA.from_chain_type(
-                llm=self.llm,
-                retriever=self.vector_store.as_retriever(search_kwargs={"k": 2}),
-                chain_type="stuff",
-                chain_type_kwargs={"prompt": self.default_prompt, "verbose": True},
-                return_source_documents=True,
+            # Retrieve more candidates than we stuff; the packer keeps the prompt within budget
+            self.search_k = 8
+            self.context_packer = ContextPacker(
+                token_budget=1500, model_name=self.llm.model_name
+            )
+
+            self.llm_chain = LLMChain(
+                llm=self.llm, prompt=self.default_prompt, verbose=True
+            )
+
+            # Variants of the same question share one translation, embedding and retrieval
+            self.query_normalizer = QueryNormalizer(
+                translate=self.translate_to_english, cache=TranslationCache()
             )
+            self.embedding_cache = LRUCache(maxsize=512)
+            self.retrieval_cache = LRUCache(maxsize=256)
 
             logger.info("Successfully set up RAG pipeline")
 
@@ -109,31 +241,99 @@ Answer:
             logger.error(f"Error setting up pipeline: {str(e)}")
             raise
 
+    def translate_to_english(self, text: str) -> str:
+        """Translate an Uzbek or Russian question into English with the LLM."""
+        return self.llm.predict(
+            "Translate the following question into English. "
+            f"Reply with the translation only.\n\n{text}"
+        ).strip()
+
+    def retrieve(
+        self,
+        search_text: str,
+        search_filter: Optional[Dict[str, Any]] = None,
+        sphere: Optional[str] = None,
+    ) -> List[Document]:
+        """Retrieve candidates for the normalized search text, reusing cached embeddings and results."""
+        sphere = sphere or self.index_name
+        cache_key = (sphere, search_text, json.dumps(search_filter, sort_keys=True))
+        documents = self.retrieval_cache.get(cache_key)
+        if documents is not None:
+            return documents
+
+        embedding = self.embedding_cache.get(search_text)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(search_text)
+            self.embedding_cache.put(search_text, embedding)
+
+        results = self.get_vector_store(sphere).similarity_search_by_vector_with_score(
+            embedding, k=self.search_k, filter=search_filter
+        )
+        documents = [doc for doc, _ in results]
+        self.retrieval_cache.put(cache_key, documents)
+        return documents
+
+    def interleave(
+        self, first: List[Document], second: List[Document]
+    ) -> List[Document]:
+        """Alternate two result lists, dropping repeats, up to the search size."""
+        merged, seen = [], set()
+        for pair in zip(first, second):
+            for doc in pair:
+                if doc.page_content not in seen:
+                    seen.add(doc.page_content)
+                    merged.append(doc)
+        for doc in first[len(second) :] + second[len(first) :]:
+            if doc.page_content not in seen:
+                seen.add(doc.page_content)
+                merged.append(doc)
+        return merged[: self.search_k]
+
     @retry(
         stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
     )
-    def query(self, question: str) -> Dict[str, Any]:
-        """Query the RAG pipeline."""
+    def query(
+        self, question: str, filters: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Query the RAG pipeline, optionally scoped by path_id, filename, sphere or year filters."""
         try:
             start_time = datetime.now()
 
+            self.refresh_metadata_index()
+            sphere = self.route(question, filters)
+            hard_filter, preferred_filter = self.retrieval_filters(question, filters, sphere)
+            if hard_filter is NO_MATCH:
+                return self.no_match_response(question, start_time)
+
             with get_openai_callback() as cb:
-                result = self.qa_chain({"query": question})
+                search_text = self.query_normalizer.search_text(question)
+                documents = self.retrieve(search_text, hard_filter, sphere)
+                if preferred_filter:
+                    # Interleave the preferred hits with the unrestricted ones
+                    preferred = self.retrieve(search_text, preferred_filter, sphere)
+                    documents = self.interleave(preferred, documents)
+                context, used_documents, packing = self.context_packer.pack(
+                    f"{question} {search_text}", documents
+                )
+
+                answer = self.llm_chain.run(context=context, question=question)
 
             end_time = datetime.now()
             processing_time = (end_time - start_time).total_seconds()
 
             return {
-                "answer": result["result"],
-                "source_documents": [
-                    doc.page_content for doc in result["source_documents"]
-                ],
+                "answer": answer,
+                "source_documents": [doc.page_content for doc in used_documents],
                 "metadata": {
                     "processing_time": processing_time,
                     "total_tokens": cb.total_tokens,
                     "prompt_tokens": cb.prompt_tokens,
                     "completion_tokens": cb.completion_tokens,
                     "total_cost": cb.total_cost,
+                    "context_tokens": packing["context_tokens"],
+                    "prompt_tokens_saved": packing["prompt_tokens_saved"],
+                    "search_text": search_text,
+                    "sphere": sphere,
                     "timestamp": datetime.now().isoformat(),
                 },
             }
@@ -142,6 +342,25 @@ Answer:
             logger.error(f"Error processing query: {str(e)}")
             raise
 
+    def no_match_response(self, question: str, start_time: datetime) -> Dict[str, Any]:
+        """Empty result for filters that match no dataset, without querying Pinecone or the LLM."""
+        logger.info(f"No dataset matches the filters of: {question}")
+        return {
+            "answer": "No datasets match the given filters.",
+            "source_documents": [],
+            "metadata": {
+                "processing_time": (datetime.now() - start_time).total_seconds(),
+                "total_tokens": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_cost": 0.0,
+                "context_tokens": 0,
+                "prompt_tokens_saved": 0,
+                "search_text": None,
+                "timestamp": datetime.now().isoformat(),
+            },
+        }
+
 
 def initialize_session_state():
     """Initialize session state variables."""
@@ -153,7 +372,7 @@ def initialize_session_state():
             st.stop()
 
     if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
+        st.session_state.chat_history = ChatHistory(max_entries=50, source_chars=200)
 
 
 def main():
@@ -195,33 +414,38 @@ def main():
                         response = st.session_state.rag_app.query(user_question)
 
                         # Add to chat history
-                        st.session_state.chat_history.append(
-                            {"question": user_question, "response": response}
-                        )
+                        st.session_state.chat_history.add(user_question, response)
 
                     except Exception as e:
                         st.error(f"Error: {str(e)}")
 
-        # Display chat history
-        if st.session_state.chat_history:
-            for chat in reversed(st.session_state.chat_history):
+        # Display one page of chat history, newest first
+        history = st.session_state.chat_history
+        if len(history):
+            num_pages = history.num_pages(HISTORY_PAGE_SIZE)
+            page = 1
+            if num_pages > 1:
+                page = st.number_input(
+                    "History page", min_value=1, max_value=num_pages, value=1, step=1
+                )
+
+            for chat in history.page(page, HISTORY_PAGE_SIZE):
                 with st.expander(f"Q: {chat['question']}", expanded=True):
                     st.markdown("**Answer:**")
-                    st.write(chat["response"]["answer"])
+                    st.write(chat["answer"])
 
                     st.markdown("**Sources:**")
-                    for idx, source in enumerate(
-                        chat["response"]["source_documents"], 1
-                    ):
+                    for idx, source in enumerate(chat["sources"], 1):
                         st.markdown(f"Source {idx}:")
-                        st.text(source[:200] + "..." if len(source) > 200 else source)
+                        st.text(source)
 
     with col2:
         # Metrics and information
         st.subheader("Session Metrics")
 
-        if st.session_state.chat_history:
-            latest = st.session_state.chat_history[-1]["response"]["metadata"]
+        history = st.session_state.chat_history
+        if history.latest:
+            latest = history.latest["metadata"]
 
             st.metric(
                 label="Processing Time",
@@ -232,24 +456,25 @@ def main():
 
             st.metric(label="Cost", value=f"${latest['total_cost']:.4f}")
 
+            st.metric(
+                label="Prompt Tokens Saved (vs. k=2 stuff chain)", value=latest.get("prompt_tokens_saved", 0)
+            )
+
             # Display cumulative statistics
             st.subheader("Cumulative Statistics")
-            total_tokens = sum(
-                chat["response"]["metadata"]["total_tokens"]
-                for chat in st.session_state.chat_history
-            )
-            total_cost = sum(
-                chat["response"]["metadata"]["total_cost"]
-                for chat in st.session_state.chat_history
-            )
+            st.metric(label="Questions Asked", value=history.count)
+
+            st.metric(label="Total Session Tokens", value=history.total_tokens)
 
-            st.metric(label="Total Session Tokens", value=total_tokens)
+            st.metric(label="Total Session Cost", value=f"${history.total_cost:.4f}")
 
-            st.metric(label="Total Session Cost", value=f"${total_cost:.4f}")
+            st.metric(
+                label="Total Prompt Tokens Saved (vs. k=2 stuff chain)", value=history.prompt_tokens_saved
+            )
 
         # Clear chat history button
         if st.button("Clear Chat History"):
-            st.session_state.chat_history = []
+            st.session_state.chat_history.clear()
             st.experimental_rerun()
 
 